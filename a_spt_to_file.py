@@ -3,7 +3,7 @@ Query SPT PSQL database for cell-level features and slide-level labels and save
 """
 from argparse import ArgumentParser
 
-from cggnn.spt_to_df import spt_to_dataframes
+from cggnn.spt_to_df import spt_to_dataframes, outputs_saved
 
 
 def parse_arguments():
@@ -62,5 +62,7 @@ def parse_arguments():
 
 if __name__ == "__main__":
     args = parse_arguments()
-    spt_to_dataframes(args.analysis_study, args.measurement_study, args.specimen_study, args.host,
-                      args.dbname, args.user, args.password, args.output_name)
+    # spt_to_dataframes would only read the saved files back, which this script has no use for
+    if not outputs_saved(args.output_name):
+        spt_to_dataframes(args.analysis_study, args.measurement_study, args.specimen_study,
+                          args.host, args.dbname, args.user, args.password, args.output_name)
@@ -58,6 +58,12 @@ def parse_arguments():
         default='/data/',
         required=False
     )
+    parser.add_argument(
+        '--compact_features',
+        help='Save node features as int8 instead of float32. Requires every feature to be an '
+        'integer between -128 and 127.',
+        action='store_true'
+    )
     return parser.parse_args()
 
 
@@ -65,4 +71,4 @@ if __name__ == "__main__":
     args = parse_arguments()
     generate_graphs(read_hdf(args.spt_hdf_cell_filename), read_hdf(args.spt_hdf_label_filename),
                     args.validation_data_percent, args.test_data_percent, args.roi_side_length,
-                    args.target_column, args.save_path)
+                    args.target_column, args.save_path, args.compact_features)
@@ -8,7 +8,7 @@ As used in:
 from typing import List
 
 from tqdm import tqdm
-from torch import FloatTensor
+from torch import FloatTensor, device
 from torch.cuda import is_available
 from dgl import DGLGraph
 from numpy import ndarray
@@ -19,7 +19,7 @@ from cggnn.util.interpretability import (BaseExplainer, GraphLRPExplainer, Graph
 from cggnn.util.constants import IMPORTANCES
 
 IS_CUDA = is_available()
-DEVICE = 'cuda:0' if IS_CUDA else 'cpu'
+DEVICE = device('cuda' if IS_CUDA else 'cpu')
 
 
 def calculate_importance(cell_graphs: List[DGLGraph],
@@ -2,121 +2,268 @@
 Create and save interactive plots.
 """
 
-from os import makedirs
+from os import makedirs, cpu_count
 from os.path import join
-from typing import List, Dict
+from contextlib import nullcontext
+from itertools import chain
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Tuple, Any
 
 from tqdm import tqdm
+from numpy import (ndarray, array, empty, nan, concatenate, argsort, r_, flatnonzero, diff,
+                   maximum, packbits)
 from dgl import DGLGraph
-from networkx import DiGraph, compose, get_node_attributes
+from networkx import DiGraph, set_node_attributes
 
-from bokeh.models import Circle, MultiLine, WheelZoomTool, HoverTool, CustomJS, Select, ColorBar
-from bokeh.plotting import figure, from_networkx
+from bokeh import __version__ as bokeh_version
+from bokeh.models import (Circle, MultiLine, WheelZoomTool, HoverTool, CustomJS, Select, ColorBar,
+                          GraphRenderer, StaticLayoutProvider, ColumnDataSource)
+from bokeh.plotting import figure
 from bokeh.transform import linear_cmap
 from bokeh.palettes import YlOrRd8
 from bokeh.layouts import row
 from bokeh.io import output_file, save
+from bokeh.resources import CDN
+from bokeh.document import Document
 
 from cggnn.util.constants import INDICES, FEATURES, PHENOTYPES, CENTROIDS, IMPORTANCES
 
+# NaN-separated lines only render correctly under WebGL from Bokeh 3.0 onwards, which is also
+# when freezing a document's model graph became public API
+IS_BOKEH_3 = int(bokeh_version.split('.')[0]) >= 3
 
-def _make_bokeh_graph_plot(graph: DiGraph,
+
+def _edges_as_single_line(plot: GraphRenderer) -> Dict[str, ndarray]:
+    "Lay out every edge of a graph renderer end to end in one NaN-separated line."
+    layout = plot.layout_provider.graph_layout
+    edge_data = plot.edge_renderer.data_source.data
+    starts = array([layout[i] for i in edge_data['start']]).reshape(-1, 2)
+    ends = array([layout[i] for i in edge_data['end']]).reshape(-1, 2)
+    xs = empty(3*starts.shape[0])
+    ys = empty(3*starts.shape[0])
+    xs[0::3] = starts[:, 0]
+    xs[1::3] = ends[:, 0]
+    xs[2::3] = nan
+    ys[0::3] = starts[:, 1]
+    ys[1::3] = ends[:, 1]
+    ys[2::3] = nan
+    return {'x': xs, 'y': ys}
+
+
+def _save_bokeh_graph_plot(plot: GraphRenderer,
+                           doc: Document,
                            feature_names: List[str],
                            phenotype_names: List[str],
                            graph_name: str,
                            out_directory: str) -> None:
-    "Create bokeh interactive graph visualization."
+    "Style a bokeh graph renderer, add interactivity, and save it to file."
 
     # Create bokeh plot and prepare to save it to file
     graph_name = graph_name.split('/')[-1]
+    # Link BokehJS from its CDN so each file doesn't embed its own copy and browsers cache it
     output_file(join(out_directory, graph_name + '.html'),
-                title=graph_name)
+                title=graph_name, mode='cdn')
+
+    # Defer recomputing the document's model graph until the whole plot is built
+    with doc.models.freeze() if IS_BOKEH_3 else nullcontext():
+        _build_bokeh_graph_layout(plot, doc, feature_names, phenotype_names, graph_name)
+    save(doc, resources=CDN)
+    doc.clear()
+
+
+def _build_bokeh_graph_layout(plot: GraphRenderer,
+                              doc: Document,
+                              feature_names: List[str],
+                              phenotype_names: List[str],
+                              graph_name: str) -> None:
+    "Lay out the graph plot with its color legend, hover tooltips, and color selector."
     f = figure(match_aspect=True, tools=[
-        'pan', 'wheel_zoom', 'reset'], title=graph_name)
+        'pan', 'wheel_zoom', 'reset'], title=graph_name, output_backend='webgl')
     f.toolbar.active_scroll = f.select_one(WheelZoomTool)
     mapper = linear_cmap(  # colors nodes according to importance by default
         'importance', palette=YlOrRd8[::-1], low=0, high=1)
-    plot = from_networkx(graph, {i_node: dat
-                                 for i_node, dat in get_node_attributes(graph, 'centroid').items()})
     plot.node_renderer.glyph = Circle(
         radius='radius', fill_color=mapper, line_width=.1, fill_alpha=.7)
-    plot.edge_renderer.glyph = MultiLine(line_alpha=0.2, line_width=.5)
+    if IS_BOKEH_3:
+        # Drawing edges as one glyph is much cheaper than managing a MultiLine entry per edge
+        f.line('x', 'y', source=ColumnDataSource(_edges_as_single_line(plot)),
+               line_alpha=0.2, line_width=.5)
+        plot.edge_renderer.visible = False
+    else:
+        plot.edge_renderer.glyph = MultiLine(line_alpha=0.2, line_width=.5)
 
     # Add color legend to right of plot
     colorbar = ColorBar(color_mapper=mapper['transform'], width=8)
     f.add_layout(colorbar, 'right')
 
-    # Define data that shows when hovering over a node/cell
+    # Define data that shows when hovering over a node/cell. Features and phenotypes are packed
+    # into one feature matrix column and one phenotype bitmask column, so decode them here.
+    names_js = 'const feats = ["' + '", "'.join(feature_names) + '"];' + \
+        'const phenotypes = ["' + '", "'.join(phenotype_names) + '"];'
     hover = HoverTool(
         tooltips="h. structure: $index", renderers=[plot.node_renderer])
     hover.callback = CustomJS(
         args=dict(hover=hover,
                   source=plot.node_renderer.data_source),
-        code='const feats = ["' + '", "'.join(feature_names) + '"];' +
-        'const phenotypes = ["' + '", "'.join(phenotype_names) + '"];' +
+        code=names_js +
         """
         if (cb_data.index.indices.length > 0) {
             const node_index = cb_data.index.indices[0];
+            const feature_row = source.data['feature_matrix'][node_index];
+            const phenotype_mask = source.data['phenotype_mask'][node_index];
             const tooltips = [['h. structure', '$index']];
-            for (const feat_name of feats) {
-                if (source.data[feat_name][node_index]) {
-                    tooltips.push([`${feat_name}`, `@${feat_name}`]);
+            feats.forEach((feat_name, i_feat) => {
+                if (feature_row[i_feat]) {
+                    tooltips.push([`${feat_name}`, `${feature_row[i_feat]}`]);
                 }
-            }
-            for (const phenotype_name of phenotypes) {
-                if (source.data[phenotype_name][node_index]) {
+            });
+            phenotypes.forEach((phenotype_name, i_phenotype) => {
+                if ((phenotype_mask[i_phenotype >> 3] >> (i_phenotype & 7)) & 1) {
                     tooltips.push([`${phenotype_name}`, "1"]);
                 }
-            }
+            });
             hover.tooltips = tooltips;
         }
     """)
 
-    # Add interactive dropdown to change why field nodes are colored by
+    # Add interactive dropdown to change why field nodes are colored by, unpacking the selected
+    # feature or phenotype into its own column
     color_select = Select(title='Color by property', value='importance', options=[
         'importance'] + feature_names + phenotype_names)
     color_select.js_on_change('value', CustomJS(
         args=dict(source=plot.node_renderer.data_source,
                   cir=plot.node_renderer.glyph),
-        code="""
+        code=names_js +
+        """
         const field = cb_obj.value;
-        cir.fill_color.field = field;
+        if (field === 'importance') {
+            cir.fill_color.field = field;
+        } else {
+            const i_feat = feats.indexOf(field);
+            let values;
+            if (i_feat >= 0) {
+                values = source.data['feature_matrix'].map((row) => row[i_feat]);
+            } else {
+                const i_phenotype = phenotypes.indexOf(field);
+                values = source.data['phenotype_mask'].map(
+                    (mask) => (mask[i_phenotype >> 3] >> (i_phenotype & 7)) & 1);
+            }
+            source.data = Object.assign({}, source.data, {'color_value': values});
+            cir.fill_color.field = 'color_value';
+        }
         source.change.emit();
         """)
     )
 
-    # Place components side-by-side and save to file
+    # Place components side-by-side and attach them to the document
     layout = row(f, color_select)
     f.renderers.append(plot)
     f.add_tools(hover)
-    save(layout)
+    doc.add_root(layout)
 
 
-def _convert_dgl_to_networkx(graph: DGLGraph,
-                             feature_names: List[str],
-                             phenotype_names: List[str]) -> DiGraph:
-    "Convert DGL graph to networkx graph for plotting interactive."
+def _make_graph_renderer(node_data: Dict[str, Any],
+                         edges: Tuple[List[int], List[int]],
+                         layout: Dict[int, List[float]]) -> GraphRenderer:
+    "Assemble a bokeh graph renderer from node data, edges, and fixed node positions."
+    plot = GraphRenderer(
+        layout_provider=StaticLayoutProvider(graph_layout=layout))
+    plot.node_renderer.data_source.data = node_data
+    plot.edge_renderer.data_source.data = {'start': edges[0], 'end': edges[1]}
+    return plot
+
+
+def _make_bokeh_graph_plot(graph: DiGraph,
+                           doc: Document,
+                           feature_names: List[str],
+                           phenotype_names: List[str],
+                           graph_name: str,
+                           out_directory: str) -> None:
+    "Create bokeh interactive graph visualization from a networkx graph."
+    node_ids = list(graph.nodes)
+    nodes = graph.nodes
+    node_data: Dict[str, Any] = {'index': node_ids}
+    for field in ('importance', 'radius'):
+        node_data[field] = array([nodes[i][field] for i in node_ids])
+    for field in ('feature_matrix', 'phenotype_mask'):
+        node_data[field] = [nodes[i][field] for i in node_ids]
+    edges = ([u for u, _ in graph.edges], [v for _, v in graph.edges])
+    layout = {i: nodes[i]['centroid'].tolist() for i in node_ids}
+    _save_bokeh_graph_plot(_make_graph_renderer(node_data, edges, layout), doc, feature_names,
+                           phenotype_names, graph_name, out_directory)
+
+
+def _make_bokeh_graph_plot_from_arrays(doc: Document,
+                                       node_ids: ndarray,
+                                       centroids: ndarray,
+                                       importances: ndarray,
+                                       features: ndarray,
+                                       phenotypes: ndarray,
+                                       edges: Tuple[ndarray, ndarray],
+                                       feature_names: List[str],
+                                       phenotype_names: List[str],
+                                       graph_name: str,
+                                       out_directory: str) -> None:
+    "Create bokeh interactive graph visualization directly from node and edge arrays."
+    node_data = {'index': node_ids.tolist(),
+                 'importance': importances,
+                 'radius': importances*10,
+                 'feature_matrix': features.tolist(),
+                 'phenotype_mask': _pack_phenotypes(phenotypes).tolist()}
+    layout = dict(zip(node_ids.tolist(), centroids.tolist()))
+    plot = _make_graph_renderer(
+        node_data, (edges[0].tolist(), edges[1].tolist()), layout)
+    _save_bokeh_graph_plot(plot, doc, feature_names,
+                           phenotype_names, graph_name, out_directory)
+
 
-    if IMPORTANCES not in graph.ndata:
+def _extract_graph_arrays(graph: DGLGraph
+                          ) -> Tuple[ndarray, ndarray, ndarray, ndarray, ndarray,
+                                     Tuple[ndarray, ndarray]]:
+    "Pull node IDs, centroids, importances, features, phenotypes, and edges out of a DGL graph."
+
+    # Fetch the node data frame once and copy each tensor off the device in a single transfer
+    ndata = graph.ndata
+    if IMPORTANCES not in ndata:
         raise ValueError(
             'importance scores not yet found. Run calculate_importance_scores first.')
 
+    indices = ndata[INDICES].detach().cpu().numpy().astype(int).ravel()
+    features = ndata[FEATURES].detach().cpu().numpy()
+    phenotypes = ndata[PHENOTYPES].detach().cpu().numpy()
+    importances = ndata[IMPORTANCES].detach().cpu().numpy()
+    centroids = ndata[CENTROIDS].detach().cpu().numpy()
+
+    # Edges are stored by node position, so convert them to histological structure IDs
+    edges_src, edges_dst = graph.edges()
+    edges = (indices[edges_src.detach().cpu().numpy()],
+             indices[edges_dst.detach().cpu().numpy()])
+    return indices, centroids, importances, features, phenotypes, edges
+
+
+def _pack_phenotypes(phenotypes: ndarray) -> ndarray:
+    "Pack each node's binary phenotype flags into a little-endian bitmask of bytes."
+    return packbits(phenotypes.astype(bool), axis=1, bitorder='little')
+
+
+def _convert_dgl_to_networkx(graph: DGLGraph) -> DiGraph:
+    "Convert DGL graph to networkx graph for plotting interactive."
+
+    indices, centroids, importances, features, phenotypes, edges = _extract_graph_arrays(
+        graph)
+    feature_matrix = features.tolist()
+    phenotype_masks = _pack_phenotypes(phenotypes).tolist()
+
     graph_networkx = DiGraph()
-    for i_g in range(graph.num_nodes()):
-        i_gx = graph.ndata[INDICES][i_g].detach(
-        ).numpy().astype(int).item()
-        graph_networkx.add_node(i_gx)
-        feats = graph.ndata[FEATURES][i_g].detach().numpy()
-        for j, feat in enumerate(feature_names):
-            graph_networkx.nodes[i_gx][feat] = feats[j]
-        phenotypes = graph.ndata[PHENOTYPES][i_g].detach().numpy()
-        for j, phenotype in enumerate(phenotype_names):
-            graph_networkx.nodes[i_gx][phenotype] = phenotypes[j]
-        graph_networkx.nodes[i_gx]['importance'] = graph.ndata[IMPORTANCES][i_g].detach(
-        ).numpy()
-        graph_networkx.nodes[i_gx]['radius'] = graph_networkx.nodes[i_gx][IMPORTANCES]*10
-        graph_networkx.nodes[i_gx]['centroid'] = graph.ndata[CENTROIDS][i_g].detach(
-        ).numpy()
+    for i_g, i_gx in enumerate(indices):
+        attributes = {'feature_matrix': feature_matrix[i_g],
+                      'phenotype_mask': phenotype_masks[i_g]}
+        attributes['importance'] = importances[i_g]
+        attributes['radius'] = importances[i_g]*10
+        attributes['centroid'] = centroids[i_g]
+        graph_networkx.add_node(int(i_gx), **attributes)
+    graph_networkx.add_edges_from(zip(edges[0].tolist(), edges[1].tolist()))
     return graph_networkx
 
 
@@ -127,26 +274,45 @@ def _stich_specimen_graphs(graphs: List[DiGraph]) -> DiGraph:
         raise ValueError("Must have at least one graph to stitch.")
     if len(graphs) == 1:
         return graphs[0]
-    graph_stitched = graphs[0]
-    for graph in graphs[1:]:
-
-        # Check for node overlaps and find the max importance score
-        overlap_importance: Dict[int, float] = {
-            i: max(graph_stitched.nodes[i]['importance'],
-                   graph.nodes[i]['importance'])
-            for i in set(graph_stitched.nodes).intersection(graph.nodes)
-        }
 
-        # Stich the next graph into the collected graph
-        graph_stitched = compose(graph_stitched, graph)
+    # Find the max importance score of every node across all graphs at once
+    node_ids = concatenate([list(graph.nodes) for graph in graphs])
+    importances = concatenate([[importance for _, importance in graph.nodes(data='importance')]
+                               for graph in graphs])
+    order = argsort(node_ids, kind='stable')
+    node_ids_sorted = node_ids[order]
+    group_starts = r_[0, flatnonzero(diff(node_ids_sorted)) + 1]
+    max_importances = maximum.reduceat(importances[order], group_starts)
 
-        # Overwrite the max importance score.
-        for i, importance in overlap_importance.items():
-            graph_stitched.nodes[i]['importance'] = importance
+    # Stitch all graphs together in one pass, with later graphs' node attributes taking
+    # precedence, then overwrite the max importance score
+    graph_stitched = DiGraph()
+    for graph in graphs:
+        graph_stitched.add_nodes_from(graph.nodes(data=True))
+    graph_stitched.add_edges_from(chain.from_iterable(graph.edges for graph in graphs))
+    set_node_attributes(graph_stitched, dict(zip(node_ids_sorted[group_starts].tolist(),
+                                                 max_importances)), 'importance')
 
     return graph_stitched
 
 
+def _plot_specimen(name: str,
+                   dgl_graphs: List[DGLGraph],
+                   feature_names: List[str],
+                   phenotype_names: List[str],
+                   out_directory: str) -> None:
+    "Create and save the bokeh interactive plot for one specimen/ROI's graphs."
+    doc = Document()
+    if len(dgl_graphs) == 1:
+        # Skip networkx entirely when there's nothing to stitch together
+        _make_bokeh_graph_plot_from_arrays(doc, *_extract_graph_arrays(dgl_graphs[0]),
+                                           feature_names, phenotype_names, name, out_directory)
+        return
+    graphs = [_convert_dgl_to_networkx(graph) for graph in dgl_graphs]
+    _make_bokeh_graph_plot(_stich_specimen_graphs(graphs), doc,
+                           feature_names, phenotype_names, name, out_directory)
+
+
 def generate_interactives(graphs_to_plot: Dict[str, List[DGLGraph]],
                           feature_names: List[str],
                           phenotype_names: List[str],
@@ -154,8 +320,10 @@ def generate_interactives(graphs_to_plot: Dict[str, List[DGLGraph]],
                           ) -> None:
     "Create bokeh interactive plots for all graphs in the out_directory."
     makedirs(out_directory, exist_ok=True)
-    for name, dgl_graphs in tqdm(graphs_to_plot.items()):
-        graphs = [_convert_dgl_to_networkx(
-            graph, feature_names, phenotype_names) for graph in dgl_graphs]
-        _make_bokeh_graph_plot(_stich_specimen_graphs(graphs),
-                               feature_names, phenotype_names, name, out_directory)
+
+    # Every plot is independent, so build them in parallel across processes
+    plot_specimen = partial(_plot_specimen, feature_names=feature_names,
+                            phenotype_names=phenotype_names, out_directory=out_directory)
+    with ProcessPoolExecutor(max_workers=cpu_count()) as executor:
+        list(tqdm(executor.map(plot_specimen, graphs_to_plot.keys(), graphs_to_plot.values()),
+                  total=len(graphs_to_plot)))
@@ -7,19 +7,23 @@ As used in:
 
 from os import makedirs
 from os.path import join
-from itertools import combinations, compress
+from itertools import combinations
 from re import sub
 from typing import List, Optional, Tuple, Dict, Union
 
 from tqdm import tqdm
-from torch import FloatTensor
+from torch import FloatTensor, cat, device
 from torch.cuda import is_available
 from dgl import DGLGraph
 from sklearn.preprocessing import minmax_scale
-from sklearn.metrics import auc
-from numpy import (empty, argsort, array, max, concatenate, reshape, histogram, corrcoef, mean,
-                   ones, all, unique, sort, ndarray, inf)
-from scipy.stats import wasserstein_distance
+from numpy import (empty, argsort, array, max, histogram,
+                   ones, all, unique, sort, ndarray, inf, cumsum, split, stack, triu_indices, abs,
+                   asarray, float32, linspace, result_type, searchsorted, bincount, arange, diff,
+                   flatnonzero, add, fmin, fmax, sqrt, argpartition)
+try:
+    from numpy import trapezoid
+except ImportError:  # NumPy < 2
+    from numpy import trapz as trapezoid
 from scipy.ndimage.filters import uniform_filter1d
 from pandas import DataFrame
 from matplotlib.pyplot import plot, title, savefig, legend, clf
@@ -30,7 +34,7 @@ from cggnn.train import infer_with_model
 
 
 IS_CUDA = is_available()
-DEVICE = 'cuda:0' if IS_CUDA else 'cpu'
+DEVICE = device('cuda' if IS_CUDA else 'cpu')
 
 
 class AttributeSeparability:
@@ -54,6 +58,8 @@ class AttributeSeparability:
         self.n_classes = len(self.classes)
         self.class_pairs = list(combinations(self.classes, 2))
         self.n_class_pairs = len(self.class_pairs)
+        # Class indices of each pair, in the same order as class_pairs
+        self.class_pair_indices = triu_indices(self.n_classes, k=1)
 
     def process(
         self,
@@ -62,7 +68,7 @@ class AttributeSeparability:
         label_list: List[int],
         attribute_names: List[str]
     ) -> Tuple[Dict[Tuple[int, int], Dict[str, float]],
-               Dict[int, Dict[int, ndarray]],
+               Dict[int, ndarray],
                Dict[Tuple[int, int], Dict[int, Tuple[int, float]]]]:
         """
         Derive metrics based on the explainer importance scores and nuclei-level concepts.
@@ -76,69 +82,53 @@ class AttributeSeparability:
         # 1. extract number of concepts
         n_attrs = attribute_list[0].shape[1]
 
-        # 2. min max normalize the importance scores
-        importance_list = self.normalize_node_importance(
-            importance_list)
-
-        # 3. extract all the histograms
+        # 2. extract all the histograms. (Importance scores are only used to rank each sample's
+        # nuclei, which min-max normalizing them wouldn't change, so they aren't normalized.)
         all_histograms = self._compute_attr_histograms(
             importance_list, attribute_list, label_list, n_attrs)
 
-        # 4. compute the Wasserstein distance for all the class pairs
+        # 3. compute the Wasserstein distance for all the class pairs
         all_distances = self._compute_hist_distances(all_histograms, n_attrs)
 
-        # 5. compute the AUC over the #k: output will be Omega x #c
+        # 4. compute the AUC over the #k: output will be Omega x #c
         # Addition: find the k-value with the max distance
+        # The k values are the same increasing x-axis for every class pair and attribute, so all
+        # the AUCs and maxima come from single reductions over the k axis.
+        keep_nuclei = array(self.keep_nuclei_list)
+        aucs = trapezoid(all_distances, x=keep_nuclei/max(keep_nuclei), axis=0)
+        i_k_max = all_distances.argmax(axis=0)
+        max_dists = all_distances.max(axis=0)
         all_aucs: Dict[Tuple[int, int], Dict[str, float]] = {}
         k_max_dist: Dict[Tuple[int, int], Dict[int, Tuple[int, float]]] = {}
-        for class_pair_id in range(self.n_class_pairs):
-            all_aucs[self.class_pairs[class_pair_id]] = {}
-            k_max_dist[self.class_pairs[class_pair_id]] = {}
-            for attr_id in range(n_attrs):
-                attr_name = attribute_names[attr_id]
-                all_aucs[self.class_pairs[class_pair_id]][attr_name] = auc(
-                    array(self.keep_nuclei_list) /
-                    max(self.keep_nuclei_list),
-                    all_distances[:, class_pair_id, attr_id]
-                )
-
-                k_max = self.keep_nuclei_list[0]
-                max_dist = all_distances[k_max, class_pair_id, attr_id]
-                for i, k in enumerate(self.keep_nuclei_list):
-                    dist = all_distances[i, class_pair_id, attr_id]
-                    if dist > max_dist:
-                        k_max = k
-                        max_dist = dist
-                k_max_dist[self.class_pairs[class_pair_id]
-                           ][attr_id] = (k_max, max_dist)
+        for class_pair_id, class_pair in enumerate(self.class_pairs):
+            all_aucs[class_pair] = dict(zip(attribute_names, aucs[class_pair_id].tolist()))
+            k_max_dist[class_pair] = {
+                attr_id: (int(keep_nuclei[i_k]), max_dist) for attr_id, (i_k, max_dist) in
+                enumerate(zip(i_k_max[class_pair_id].tolist(), max_dists[class_pair_id].tolist()))}
 
         return all_aucs, all_histograms, k_max_dist
 
     def _compute_hist_distances(
         self,
-        all_histograms: Dict,
+        all_histograms: Dict[int, ndarray],
         n_attr: int
     ) -> ndarray:
         """
         Compute all the pair-wise histogram distances.
 
+        The Wasserstein distance is taken between the histograms' bin values treated as samples,
+        as scipy.stats.wasserstein_distance(hist_a, hist_b) does. For two samples of the same size
+        that's the mean absolute difference of their sorted values, so every class pair and
+        attribute can be computed at once.
+
         Args:
              all_histograms (Dict): all the histograms.
              n_concepts (int): number of concepts.
         """
-        all_distances = empty(
-            (self.n_keep_nuclei, self.n_class_pairs, n_attr))
-        for k_id, k in enumerate(self.keep_nuclei_list):
-            omega = 0
-            for tx in range(self.n_classes):
-                for ty in range(self.n_classes):
-                    if tx < ty:
-                        for attr_id in range(n_attr):
-                            all_distances[k_id, omega, attr_id] = wasserstein_distance(
-                                all_histograms[k][tx][attr_id],
-                                all_histograms[k][ty][attr_id]
-                            )
-                        omega += 1
+        class_x, class_y = self.class_pair_indices
+        sorted_histograms = sort(stack([all_histograms[k] for k in self.keep_nuclei_list]), axis=-1)
+        all_distances = abs(sorted_histograms[:, class_x] -
+                            sorted_histograms[:, class_y]).mean(axis=-1)
         return all_distances
 
     def _compute_attr_histograms(
@@ -147,7 +137,7 @@ class AttributeSeparability:
         attribute_list: List[ndarray],
         label_list: List[int],
         n_attrs: int
-    ) -> Dict[int, Dict[int, ndarray]]:
+    ) -> Dict[int, ndarray]:
         """
         Compute histograms for all the attributes.
 
@@ -156,53 +146,57 @@ class AttributeSeparability:
             attribute_list (List[ndarray]): Cell-level attributes.
             label_list (List[int]): Labels.
         Returns:
-            all_histograms (Dict[int, Dict[int, ndarray]]): Dict with all the histograms
-                                                            for each thresh k (as key),
-                                                            tumor type (as key) and
-                                                            attributes (as np array).
+            all_histograms (Dict[int, ndarray]): Dict with all the histograms for each thresh k
+                                                 (as key), as an array indexed by tumor type,
+                                                 attribute, and bin.
         """
-        all_histograms: Dict[int, Dict[int, ndarray]] = {}
+        all_histograms: Dict[int, ndarray] = {}
+
+        # Rank each sample's nuclei by importance once and gather the attributes of the most
+        # important nuclei for the largest k into one preallocated array. Every k's top nuclei are
+        # the last k of those, in the same order.
+        max_k = max(self.keep_nuclei_list)
+        top_attrs = empty((len(attribute_list), max_k, n_attrs), dtype=attribute_list[0].dtype)
+        for i_sample, (c, s) in enumerate(zip(attribute_list, importance_list)):
+            # Only the top max_k need ranking, so select them first and sort just those
+            top = argpartition(s, -max_k)[-max_k:]
+            top_attrs[i_sample] = c[top[argsort(s[top])]]
+        top_attrs[top_attrs == inf] = 0  # ensure no weird values in attributes
+
+        # Find which samples belong to each class once, since the labels are the same for every k
+        labels = asarray(label_list)
+        class_sample_ids = [flatnonzero(labels == t) for t in range(self.n_classes)]
+        for t, sample_ids in enumerate(class_sample_ids):
+            if len(sample_ids) == 0:
+                raise RuntimeError(f'Missing samples of class {t}')
+
+        # Each k's attributes are min-max scaled over that k's nuclei. Every k's nuclei include the
+        # smaller ks', so each k's attribute ranges can be read off running minima and maxima down
+        # the importance ranking instead of rescanning its nuclei. (NaNs are ignored, as in
+        # sklearn's minmax_scale.)
+        most_important_first = top_attrs[:, ::-1, :]
+        top_k_mins = fmin.reduce(fmin.accumulate(most_important_first, axis=1), axis=0)
+        top_k_maxs = fmax.reduce(fmax.accumulate(most_important_first, axis=1), axis=0)
+
         for k in self.keep_nuclei_list:
-            all_histograms[k] = {}
+            histograms_k = []
 
-            attrs = [c[argsort(s)[-k:]]
-                     for c, s in zip(attribute_list, importance_list)]
-            attrs = concatenate(attrs, axis=0)  # (#samples x k) x #attrs
-            attrs[attrs == inf] = 0  # ensure no weird values in attributes
-            attrs = minmax_scale(attrs)
             # #samples x k x #attrs
-            attrs = reshape(attrs, (-1, k, n_attrs))
-            attrs = list(attrs)
+            attr_mins = top_k_mins[k - 1]
+            attr_ranges = top_k_maxs[k - 1] - attr_mins
+            attr_ranges[attr_ranges == 0] = 1
+            attrs = (top_attrs[:, -k:, :] - attr_mins) / attr_ranges
 
-            for t in range(self.n_classes):
+            for sample_ids in class_sample_ids:
 
                 # i. extract the samples of type t
-                selected_attrs = [a for l, a in zip(
-                    label_list, attrs) if l == t]
-                if len(selected_attrs) == 0:
-                    raise RuntimeError(f'Missing samples of class {t}')
-                selected_attrs = concatenate(selected_attrs, axis=0)
+                selected_attrs = attrs[sample_ids].reshape(-1, n_attrs)
 
                 # iii. build the histogram for all the attrs (dim = #nuclei x attr_types)
-                all_histograms[k][t] = array(
-                    [self.build_hist(selected_attrs[:, attr_id])
-                     for attr_id in range(selected_attrs.shape[1])]
-                )
+                histograms_k.append(self.build_hists(selected_attrs))
+            all_histograms[k] = stack(histograms_k)
         return all_histograms
 
-    @staticmethod
-    def normalize_node_importance(node_importance: List[ndarray]) -> List[ndarray]:
-        """
-        Normalize node importance. Min-max normalization on each sample.
-
-        Args:
-            node_importance (List[ndarray]): node importance output by an explainer.
-        Returns:
-            node_importance (List[ndarray]): Normalized node importance.
-        """
-        node_importance = [minmax_scale(x) for x in node_importance]
-        return node_importance
-
     @staticmethod
     def build_hist(concept_values: ndarray, num_bins: int = 100) -> ndarray:
         """
@@ -218,6 +212,34 @@ class AttributeSeparability:
             concept_values, bins=num_bins, range=(0., 1.), density=True)
         return hist
 
+    @staticmethod
+    def build_hists(concept_values: ndarray, num_bins: int = 100) -> ndarray:
+        """
+        Build a 1D histogram for every concept at once, the same as calling build_hist on each.
+
+        Args:
+            concept_values (ndarray): All the nuclei-level values for each concept, one per column.
+            num_bins (int): Number of bins in each histogram. Default to 100.
+        Returns:
+            hists (ndarray): Histograms, one per row, as float32.
+        """
+        n_concepts = concept_values.shape[1]
+
+        # Bin like numpy.histogram does: with edges in the values' precision, half-open bins
+        # except for the last, and values outside the range (or NaN) left out
+        bin_edges = linspace(0., 1., num_bins + 1, dtype=result_type(0., 1., concept_values))
+        bin_ids = searchsorted(bin_edges, concept_values, side='right') - 1
+        bin_ids[concept_values == bin_edges[-1]] = num_bins - 1
+        in_range = (bin_ids >= 0) & (bin_ids < num_bins)
+
+        # Count every concept's bins in one pass by giving each concept its own block of bin IDs
+        counts = bincount((bin_ids + arange(n_concepts)*num_bins)[in_range],
+                          minlength=n_concepts*num_bins).reshape(n_concepts, num_bins)
+        # Densities are kept in float32, which is plenty for comparing distributions and halves the
+        # memory the distance computations stream through
+        return (counts / counts.sum(axis=1, keepdims=True)).astype(float32) / \
+            diff(bin_edges).astype(float32)
+
 
 class SeparabilityAggregator:
 
@@ -233,13 +255,18 @@ class SeparabilityAggregator:
             separability_score (Dict[Dict][float]): Separability score for all the class pairs
                                                     (as key) and attributes (as key).
         """
-        self.separability_scores = self._group_separability_scores(
+        self.class_pairs = list(separability_scores.keys())
+        self.concepts = list(concept_grouping.keys())
+        self.scores = self._group_separability_scores(
             separability_scores, concept_grouping)
+        self.separability_scores: Dict[Tuple[int, int], Dict[str, float]] = {
+            class_pair: dict(zip(self.concepts, self.scores[i_pair].tolist()))
+            for i_pair, class_pair in enumerate(self.class_pairs)}
 
     def _group_separability_scores(self,
                                    sep_scores: Dict[Tuple[int, int], Dict[str, float]],
                                    concept_grouping: Dict[str, List[str]]
-                                   ) -> Dict[Tuple[int, int], Dict[str, float]]:
+                                   ) -> ndarray:
         """
         Group the individual attribute-wise separability scores according
         to the grouping concept.
@@ -247,17 +274,31 @@ class SeparabilityAggregator:
         Args:
             sep_scores (Dict[Tuple[int, int], Dict[str, float]]): Separability scores
         Returns:
-            grouped_sep_scores (Dict[int, Dict[str, float]]): Grouped separability scores
+            grouped_sep_scores (ndarray): Grouped separability scores, indexed by class pair and
+                                          concept
         """
-        grouped_sep_scores: Dict[Tuple[int, int], Dict[str, float]] = {}
-
-        for class_pair, class_pair_val in sep_scores.items():
-            grouped_sep_scores[class_pair] = {}
-            for concept_key, concept_attrs in concept_grouping.items():
-                val = sum([class_pair_val[attr]
-                          for attr in concept_attrs]) / len(concept_attrs)
-                grouped_sep_scores[class_pair][concept_key] = val
-        return grouped_sep_scores
+        attributes = list(next(iter(sep_scores.values())).keys())
+        attribute_scores = array([[class_pair_val[attr] for attr in attributes]
+                                  for class_pair_val in sep_scores.values()])
+
+        # Line up each concept's attributes one after another so every concept's average is one
+        # contiguous segment of a single reduction
+        attribute_index = {attr: i for i, attr in enumerate(attributes)}
+        concept_sizes = array([len(concept_attrs) for concept_attrs in concept_grouping.values()])
+        concept_attr_ids = [attribute_index[attr] for concept_attrs in concept_grouping.values()
+                            for attr in concept_attrs]
+        concept_starts = cumsum(concept_sizes) - concept_sizes
+        return add.reduceat(attribute_scores[:, concept_attr_ids], concept_starts, axis=1) / \
+            concept_sizes
+
+    def _aggregate(self, per_pair: ndarray, risk: ndarray
+                   ) -> Dict[Union[Tuple[int, int], str], float]:
+        "Report a score per class pair alongside its risk-weighted and unweighted aggregates."
+        scores: Dict[Union[Tuple[int, int], str], float] = dict(
+            zip(self.class_pairs, per_pair.tolist()))
+        scores['agg_with_risk'] = (per_pair * risk).sum()
+        scores['agg'] = per_pair.sum()
+        return scores
 
     def compute_max_separability_score(self, risk: ndarray) -> Dict[Union[Tuple[int, int], str], float]:
         """
@@ -267,17 +308,7 @@ class SeparabilityAggregator:
         Returns:
             max_sep_score (Dict[Union[Tuple[int, int], str], float]): Maximum separability score.
         """
-        max_sep_score: Dict[Union[Tuple[int, int], str], float] = {}
-        for class_pair, class_pair_val in self.separability_scores.items():
-            max_sep_score[class_pair] = max(
-                [val for _, val in class_pair_val.items()])
-        max_sep_score['agg_with_risk'] = sum(
-            array([val for _, val in max_sep_score.items()]) *
-            risk
-        )
-        max_sep_score['agg'] = sum(
-            [val for key, val in max_sep_score.items() if isinstance(key, tuple)])
-        return max_sep_score
+        return self._aggregate(self.scores.max(axis=1), risk)
 
     def compute_average_separability_score(self, risk: ndarray) -> Dict[Union[Tuple[int, int], str], float]:
         """
@@ -287,17 +318,7 @@ class SeparabilityAggregator:
         Returns:
             avg_sep_score (Dict[Union[Tuple[int, int], str], float]): Average separability score.
         """
-        avg_sep_score: Dict[Union[Tuple[int, int], str], float] = {}
-        for class_pair, class_pair_val in self.separability_scores.items():
-            avg_sep_score[class_pair] = mean(
-                array([val for _, val in class_pair_val.items()]))
-        avg_sep_score['agg_with_risk'] = sum(
-            array([val for _, val in avg_sep_score.items()]) *
-            risk
-        )
-        avg_sep_score['agg'] = sum(
-            [val for key, val in avg_sep_score.items() if isinstance(key, tuple)])
-        return avg_sep_score
+        return self._aggregate(self.scores.mean(axis=1), risk)
 
     def compute_correlation_separability_score(self,
                                                risk: ndarray,
@@ -310,25 +331,18 @@ class SeparabilityAggregator:
         Returns:
             corr_sep_score (Dict[Union[Tuple[int, int], str], float]): Correlation separability score.
         """
-        sep_scores = DataFrame.from_dict(
-            self.separability_scores).to_numpy()
-        class_pairs = list(self.separability_scores.keys())
-        sep_scores = minmax_scale(sep_scores)
-        corrs: Dict[Union[Tuple[int, int], str], float] = {}
-        for i_class_pair in range(sep_scores.shape[1]):
-            corr_sep_score = corrcoef(
-                pathological_prior[:, i_class_pair], sep_scores[:, i_class_pair])
-            corrs[class_pairs[i_class_pair]] = corr_sep_score[1, 0]
-        corrs['agg_with_risk'] = sum(
-            array([val for _, val in corrs.items()]) *
-            risk
-        )
-        corrs['agg'] = sum(
-            [val for key, val in corrs.items() if isinstance(key, tuple)])
-        return corrs
-
-
-def plot_histogram(all_histograms: Dict[int, Dict[int, ndarray]],
+        # concept x class pair, like the prior
+        sep_scores = minmax_scale(self.scores.T)
+
+        # Pearson correlation between each class pair's column of prior and scores, all at once
+        prior_centered = pathological_prior - pathological_prior.mean(axis=0)
+        scores_centered = sep_scores - sep_scores.mean(axis=0)
+        correlations = (prior_centered*scores_centered).sum(axis=0) / sqrt(
+            (prior_centered**2).sum(axis=0) * (scores_centered**2).sum(axis=0))
+        return self._aggregate(correlations, risk)
+
+
+def plot_histogram(all_histograms: Dict[int, ndarray],
                    save_path: str,
                    attr_id: int,
                    attr_name: str,
@@ -337,7 +351,7 @@ def plot_histogram(all_histograms: Dict[int, Dict[int, ndarray]],
     "Create histogram for a single attribute."
 
     x = array(list(range(100)))
-    for i, histogram in all_histograms[k].items():
+    for i, histogram in enumerate(all_histograms[k]):
         plot(x, uniform_filter1d(
             histogram[attr_id], size=5) if smoothing else histogram[attr_id], label=f'Class {i}')
 
@@ -350,9 +364,9 @@ def plot_histogram(all_histograms: Dict[int, Dict[int, ndarray]],
 def _misclassified(cell_graphs: List[DGLGraph],
                    cell_graph_labels: List[int],
                    model: CellGraphModel
-                   ) -> List[bool]:
+                   ) -> ndarray:
     "Identify which samples are misclassified."
-    return (array(cell_graph_labels) == infer_with_model(model, cell_graphs)).tolist()
+    return array(cell_graph_labels) == infer_with_model(model, cell_graphs)
 
 
 def calculate_separability(cell_graphs_and_labels: Tuple[List[DGLGraph], List[int]],
@@ -368,14 +382,17 @@ def calculate_separability(cell_graphs_and_labels: Tuple[List[DGLGraph], List[in
                            ) -> Tuple[DataFrame, DataFrame, Dict[Tuple[int, int], DataFrame]]:
     "Generate separability scores for each concept."
 
-    # Get the importance scores, labels, features, and phenotypes from all cell graphs
-    importance_scores = [graph.ndata[IMPORTANCES]
-                         for graph in cell_graphs_and_labels[0]]
+    # Get the importance scores, labels, features, and phenotypes from all cell graphs. Stack each
+    # across all graphs first so they're converted in one go, then split them back up per graph
+    # into views of the stacked arrays.
+    graphs = cell_graphs_and_labels[0]
+    graph_offsets = cumsum([graph.num_nodes() for graph in graphs])[:-1]
+    importance_scores = split(cat([graph.ndata[IMPORTANCES] for graph in graphs]
+                                  ).detach().cpu().numpy(), graph_offsets)
     labels = cell_graphs_and_labels[1]
-    attributes = [concatenate((features, phenotypes), axis=1) for features, phenotypes in zip(
-        [graph.ndata[FEATURES] for graph in cell_graphs_and_labels[0]],
-        [graph.ndata[PHENOTYPES] for graph in cell_graphs_and_labels[0]]
-    )]
+    attributes = split(cat((cat([graph.ndata[FEATURES] for graph in graphs]).float(),
+                            cat([graph.ndata[PHENOTYPES] for graph in graphs]).float()), dim=1
+                           ).detach().cpu().numpy(), graph_offsets)
     attribute_names = feature_names + phenotype_names
 
     assert len(importance_scores) == len(labels) == len(attributes)
@@ -394,10 +411,10 @@ def calculate_separability(cell_graphs_and_labels: Tuple[List[DGLGraph], List[in
         assert len(risk) == len(classes)
 
     if prune_misclassified:
-        mask = _misclassified(cell_graphs_and_labels[0], labels, model)
-        importance_scores = list(compress(importance_scores, mask))
-        attributes = list(compress(attributes, mask))
-        labels = list(compress(labels, mask))
+        i_kept = flatnonzero(_misclassified(cell_graphs_and_labels[0], labels, model)).tolist()
+        importance_scores = [importance_scores[i] for i in i_kept]
+        attributes = [attributes[i] for i in i_kept]
+        labels = [labels[i] for i in i_kept]
 
     # Compute separability scores
     least_cells = attributes[0].shape[0]
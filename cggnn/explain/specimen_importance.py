@@ -3,10 +3,10 @@ Given the importance scores for cells per ROI in a specimen, find an importance
 scale for all cells in ROIs across the entire specimen.
 """
 
-from typing import Dict, List, Tuple, DefaultDict
+from typing import Dict, List
 
 from dgl import DGLGraph
-from numpy import average
+from numpy import concatenate, repeat, unique, bincount
 from pandas import Series
 
 from cggnn.util import CellGraphModel
@@ -17,17 +17,18 @@ from cggnn.train import infer_with_model
 def unify_importance(graphs: List[DGLGraph], model: CellGraphModel) -> Dict[int, float]:
     "Merge the importance values for all cells in a single specimen."
     probs = infer_with_model(model, graphs, return_probability=True)
-    hs_id_to_importances: Dict[int,
-                               List[Tuple[float, float]]] = DefaultDict(list)
-    for i_graph, graph in enumerate(graphs):
-        for i in range(graph.num_nodes()):
-            hs_id_to_importances[graph.ndata[INDICES][i].item()].append(
-                (graph.ndata[IMPORTANCES][i], max(probs[i_graph, ])))
-    hs_id_to_importance: Dict[int, float] = {}
-    for hs_id, importance_confidences in hs_id_to_importances.items():
-        hs_id_to_importance[hs_id] = average([ic[0] for ic in importance_confidences],
-                                             weights=[ic[1] for ic in importance_confidences])
-    return hs_id_to_importance
+
+    # Line up every node of every ROI with its histological structure ID and its ROI's confidence,
+    # then take the confidence-weighted average importance per ID all at once
+    hs_ids = concatenate([graph.ndata[INDICES].detach().cpu().numpy().ravel()
+                          for graph in graphs])
+    importances = concatenate([graph.ndata[IMPORTANCES].detach().cpu().numpy().ravel()
+                               for graph in graphs])
+    confidences = repeat(probs.max(axis=1), [graph.num_nodes() for graph in graphs])
+    unique_hs_ids, hs_id_of_node = unique(hs_ids, return_inverse=True)
+    weighted_importance_sums = bincount(hs_id_of_node, weights=importances*confidences)
+    confidence_sums = bincount(hs_id_of_node, weights=confidences)
+    return dict(zip(unique_hs_ids.tolist(), (weighted_importance_sums/confidence_sums).tolist()))
 
 
 def unify_importance_across(graphs_by_specimen: List[List[DGLGraph]],
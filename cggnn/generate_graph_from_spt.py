@@ -1,88 +1,179 @@
 "Generates graph from saved SPT files."
-from os import makedirs, listdir
+from os import makedirs, listdir, cpu_count
 from os.path import join, isdir
 from random import shuffle, randint
 from warnings import warn
-from typing import Optional, Tuple, List, Dict, DefaultDict
-
-from torch import Tensor, FloatTensor, IntTensor
-from numpy import ndarray, round, prod, percentile, argmin, nonzero
+from functools import partial
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from typing import Optional, Tuple, List, Dict, DefaultDict, Deque
+
+from torch import Tensor, as_tensor, from_numpy, int32, int64, float32 as torch_float32
+from numpy import ndarray, round, argmin, arange, repeat, ones_like, ascontiguousarray, \
+    float32, int8, cumsum, searchsorted, fill_diagonal, inf, argpartition, take_along_axis
 from dgl import DGLGraph, graph
 from dgl.data.utils import save_graphs
-from sklearn.neighbors import kneighbors_graph
 from pandas import DataFrame
-from scipy.spatial.distance import pdist, squareform
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
 
 from cggnn.util import GraphData
 from cggnn.util.constants import CENTROIDS, FEATURES, INDICES, PHENOTYPES, TRAIN_VALIDATION_TEST
 
+# ROIs with at most this many cells find kNN edges from a dense distance matrix
+DENSE_KNN_MAX_NODES = 2048
+
+
+def _in_bounding_box(xy: ndarray,
+                     x_min: float,
+                     x_max: float,
+                     y_min: float,
+                     y_max: float) -> ndarray:
+    "Find which points fall within a bounding box (inclusive)."
+    return (xy[:, 0] >= x_min) & (xy[:, 0] <= x_max) & (xy[:, 1] >= y_min) & (xy[:, 1] <= y_max)
+
+
+def _fits_int8(df_features: DataFrame) -> bool:
+    "Check whether every feature is an integer in int8 range, as SPT's binary ones are."
+    return (df_features.min().min() >= -128) and (df_features.max().max() <= 127) and \
+        (df_features == df_features.round()).all().all()
+
+
+def _pick_rois(xy_target: ndarray,
+               proportion_of_target: float,
+               image_size: Tuple[int, int],
+               slide_size: Tuple[float, float]
+               ) -> List[Tuple[int, int, int, int, int, int]]:
+    """Greedily choose ROI bounding boxes centered on target cells.
+
+    Creates as many ROIs such that the total area of the ROIs will equal the area of the source
+    image times the proportion of cells on that image that have the target phenotype.
+    """
+    bounding_boxes: List[Tuple[int, int, int, int, int, int]] = []
+    roi_area = image_size[0] * image_size[1]
+    slide_area = slide_size[0] * slide_size[1]
+    roi_over_slide = roi_area / slide_area
+    n_rois = round(proportion_of_target * slide_area / roi_area)
+    while (len(bounding_boxes) < n_rois) and (xy_target.shape[0] > 0):
+
+        # Center the ROI on the densest remaining target cell, i.e. the one with the smallest
+        # proportion_of_target-th percentile of distances to the target cells (itself included).
+        # Like numpy.percentile, interpolate linearly between the two order statistics that
+        # percentile falls between. The jth smallest distance is the distance to the (j + 1)th
+        # nearest neighbor, counting the cell itself as the first, which a KD-tree finds without
+        # computing every pairwise distance or sorting them. The tree is rebuilt every iteration
+        # and queried once, so skip the build-time balancing that only pays off over many queries.
+        rank = proportion_of_target/100*(xy_target.shape[0] - 1)
+        lower = int(rank)
+        fraction = rank - lower
+        tree = cKDTree(xy_target, balanced_tree=False, compact_nodes=False)
+        if fraction > 0:
+            neighbor_distances, _ = tree.query(xy_target, k=[lower + 1, lower + 2])
+            p_dist = neighbor_distances[:, 0] + \
+                fraction*(neighbor_distances[:, 1] - neighbor_distances[:, 0])
+        else:
+            neighbor_distances, _ = tree.query(xy_target, k=[lower + 1])
+            p_dist = neighbor_distances[:, 0]
+        x, y = xy_target[argmin(p_dist)].tolist()
+        x_min = x - image_size[0]//2
+        x_max = x + image_size[0]//2
+        y_min = y - image_size[1]//2
+        y_max = y + image_size[1]//2
+        bounding_boxes.append((x_min, x_max, y_min, y_max, x, y))
+        proportion_of_target -= roi_over_slide
+        xy_target = xy_target[~_in_bounding_box(xy_target, x_min, x_max, y_min, y_max)]
+    return bounding_boxes
+
+
+def _create_specimen_graphs(specimen: str,
+                            df_specimen: DataFrame,
+                            image_size: Tuple[int, int],
+                            target_column: Optional[str] = None,
+                            k_folds: int = 5,
+                            threshold: Optional[int] = None,
+                            feature_dtype: type = float32
+                            ) -> Tuple[List[DGLGraph], List[str]]:
+    "Create the ROI graphs and their names for one specimen (slide)."
+
+    # Find the target cells to center ROIs on
+    slide_size = df_specimen[['center_x', 'center_y']].max() + 100
+    if target_column is not None:
+        column_name = f'PH_{target_column}'
+        proportion_of_target = df_specimen[column_name].sum(
+        )/df_specimen.shape[0]
+        df_target = df_specimen.loc[df_specimen[column_name], :]
+    else:
+        proportion_of_target = 1.
+        df_target = df_specimen
+    bounding_boxes = _pick_rois(ascontiguousarray(df_target[['center_x', 'center_y']].to_numpy()),
+                                proportion_of_target, image_size, tuple(slide_size))
+
+    # Create feature, centroid, and label arrays for the whole specimen once, then slice out
+    # each ROI's cells to create its graph. Phenotypes are made float32 and features their
+    # storage dtype here so the graph's tensors can share memory with each ROI's slice.
+    # Coordinates keep their full precision for ROI membership and neighbor search, and are only
+    # stored as float32 on the graph.
+    node_indices_specimen = df_specimen.index.to_numpy()
+    xy_specimen = df_specimen[['center_x', 'center_y']].to_numpy()
+    features_specimen = df_specimen.loc[:, df_specimen.columns.str.startswith(
+        'FT_')].to_numpy(dtype=float32).astype(feature_dtype, copy=False)
+    phenotypes_specimen = df_specimen.loc[:, df_specimen.columns.str.startswith(
+        'PH_')].to_numpy(dtype=float32)
+    graphs: List[DGLGraph] = []
+    names: List[str] = []
+    for i, (x_min, x_max, y_min, y_max, x, y) in enumerate(bounding_boxes):
+        in_roi = _in_bounding_box(xy_specimen, x_min, x_max, y_min, y_max)
+        graphs.append(_create_graph(
+            node_indices_specimen[in_roi], xy_specimen[in_roi], features_specimen[in_roi],
+            phenotypes_specimen[in_roi], k_folds=k_folds, threshold=threshold))
+        names.append(f'melanoma_{specimen}_{i}_{image_size[0]}x{image_size[1]}_x{x}_y{y}')
+    return graphs, names
+
 
 def _create_graphs_from_spt_file(df_cell_all_specimens: DataFrame,
                                  df_label_all_specimens: DataFrame,
                                  image_size: Tuple[int, int],
                                  target_column: Optional[str] = None,
                                  k_folds: int = 5,
-                                 threshold: Optional[int] = None
+                                 threshold: Optional[int] = None,
+                                 compact_features: bool = False
                                  ) -> Tuple[Dict[int, Dict[str, List[DGLGraph]]],
                                             Dict[DGLGraph, str]]:
     "Create graphs from cell and label files created from SPT."
 
-    # Split the data by specimen (slide)
-    graphs_by_specimen: Dict[str, List[DGLGraph]] = DefaultDict(list)
+    # Split the data by specimen (slide) and create each specimen's graphs in parallel, since
+    # specimens are independent of each other. Specimens are submitted as the groupby yields
+    # them with only a bounded number in flight, so only a few specimen-sized copies of the
+    # cell DataFrame exist at any time instead of one for every specimen.
+    feature_dtype = float32
+    if compact_features:
+        if not _fits_int8(df_cell_all_specimens.loc[
+                :, df_cell_all_specimens.columns.str.startswith('FT_')]):
+            raise ValueError('Features can only be stored compactly if they are all integers '
+                             'between -128 and 127.')
+        feature_dtype = int8
+    create_specimen_graphs = partial(_create_specimen_graphs, image_size=image_size,
+                                     target_column=target_column, k_folds=k_folds,
+                                     threshold=threshold, feature_dtype=feature_dtype)
+    graphs_by_specimen: Dict[str, List[DGLGraph]] = {}
     roi_names: Dict[DGLGraph, str] = {}
-    for specimen, df_specimen in df_cell_all_specimens.groupby('specimen'):
-
-        # Initialize data structures
-        bounding_boxes: List[Tuple[int, int, int, int, int, int]] = []
-        slide_size = df_specimen[['center_x', 'center_y']].max() + 100
-        if target_column is not None:
-            column_name = f'PH_{target_column}'
-            proportion_of_target = df_specimen[column_name].sum(
-            )/df_specimen.shape[0]
-            df_target = df_specimen.loc[df_specimen[column_name], :]
-        else:
-            proportion_of_target = 1.
-            df_target = df_specimen
-        distance_square = squareform(
-            pdist(df_target[['center_x', 'center_y']]))
-
-        # Create as many ROIs such that the total area of the ROIs will equal the area of the
-        # source image times the proportion of cells on that image that have the target phenotype
-        n_rois = round(
-            proportion_of_target * prod(slide_size) / prod(image_size))
-        while (len(bounding_boxes) < n_rois) and (df_target.shape[0] > 0):
-            p_dist = percentile(distance_square, proportion_of_target, axis=0)
-            x, y = df_specimen.iloc[argmin(
-                p_dist), :][['center_x', 'center_y']].tolist()
-            x_min = x - image_size[0]//2
-            x_max = x + image_size[0]//2
-            y_min = y - image_size[1]//2
-            y_max = y + image_size[1]//2
-            bounding_boxes.append((x_min, x_max, y_min, y_max, x, y))
-            proportion_of_target -= prod(image_size) / prod(slide_size)
-            cells_to_keep = ~df_target['center_x'].between(
-                x_min, x_max) & ~df_target['center_y'].between(y_min, y_max)
-            df_target = df_target.loc[cells_to_keep, :]
-            distance_square = distance_square[cells_to_keep,
-                                              :][:, cells_to_keep]
-
-        # Create feature, centroid, and label arrays and then the graph
-        df_features = df_specimen.loc[:,
-                                      df_specimen.columns.str.startswith('FT_')]
-        df_phenotypes = df_specimen.loc[:,
-                                        df_specimen.columns.str.startswith('PH_')]
-        for i, (x_min, x_max, y_min, y_max, x, y) in enumerate(bounding_boxes):
-            df_roi: DataFrame = df_specimen.loc[df_specimen['center_x'].between(
-                x_min, x_max) & df_specimen['center_y'].between(y_min, y_max), ]
-            centroids = df_roi[['center_x', 'center_y']].values
-            features = df_features.loc[df_roi.index, ].astype(int).values
-            phenotypes = df_phenotypes.loc[df_roi.index, ].astype(int).values
-            graph_instance = _create_graph(
-                df_roi.index.to_numpy(), centroids, features, phenotypes, k_folds=k_folds,
-                threshold=threshold)
-            graphs_by_specimen[specimen].append(graph_instance)
-            roi_names[graph_instance] = \
-                f'melanoma_{specimen}_{i}_{image_size[0]}x{image_size[1]}_x{x}_y{y}'
+
+    def collect(specimen: str, future: Future) -> None:
+        graphs, names = future.result()
+        if len(graphs) > 0:
+            graphs_by_specimen[specimen] = graphs
+        roi_names.update(zip(graphs, names))
+
+    max_workers = cpu_count() or 1
+    pending: Deque[Tuple[str, Future]] = deque()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for specimen, df_specimen in df_cell_all_specimens.groupby('specimen'):
+            pending.append((specimen, executor.submit(create_specimen_graphs, specimen,
+                                                      df_specimen)))
+            if len(pending) > 2*max_workers:
+                collect(*pending.popleft())
+        while len(pending) > 0:
+            collect(*pending.popleft())
 
     # Split the graphs by specimen and label
     graphs_by_label_and_specimen: Dict[int,
@@ -93,6 +184,31 @@ def _create_graphs_from_spt_file(df_cell_all_specimens: DataFrame,
     return graphs_by_label_and_specimen, roi_names
 
 
+def _k_nearest_neighbors(centroids: ndarray,
+                         k: int,
+                         threshold: Optional[int] = None
+                         ) -> Tuple[ndarray, ndarray]:
+    """Find each node's k nearest other nodes and which of them are within the threshold.
+
+    Most ROIs have few enough cells that a dense distance matrix with an O(N) partial sort per
+    row beats building a KD-tree; larger ones fall back to the tree to keep memory linear.
+    """
+    if centroids.shape[0] <= DENSE_KNN_MAX_NODES:
+        sq_distances = cdist(centroids, centroids, 'sqeuclidean')
+        fill_diagonal(sq_distances, inf)
+        neighbors = argpartition(sq_distances, k - 1, axis=1)[:, :k]
+        if threshold is None:
+            return neighbors, ones_like(neighbors, dtype=bool)
+        return neighbors, take_along_axis(sq_distances, neighbors, axis=1) <= threshold**2
+
+    # query one extra neighbor because each node's nearest is itself
+    distances, neighbors = cKDTree(centroids).query(centroids, k=k + 1)
+    neighbors = neighbors[:, 1:]
+    if threshold is None:
+        return neighbors, ones_like(neighbors, dtype=bool)
+    return neighbors, distances[:, 1:] <= threshold
+
+
 def _create_graph(node_indices: ndarray,
                   centroids: ndarray,
                   features: ndarray,
@@ -113,30 +229,23 @@ def _create_graph(node_indices: ndarray,
         DGLGraph: The constructed graph
     """
 
-    # add nodes
+    # build kNN edges
     num_nodes = features.shape[0]
-    graph_instance = graph([])
-    graph_instance.add_nodes(num_nodes)
-    graph_instance.ndata[INDICES] = IntTensor(node_indices)
-    graph_instance.ndata[CENTROIDS] = FloatTensor(centroids)
-    graph_instance.ndata[FEATURES] = FloatTensor(features)
-    graph_instance.ndata[PHENOTYPES] = FloatTensor(phenotypes)
-    # Note: features and phenotypes are binary variables, but DGL only supports FloatTensors
-
-    # build kNN adjacency
-    adj = kneighbors_graph(
-        centroids,
-        k_folds,
-        mode="distance",
-        include_self=False,
-        metric="euclidean").toarray()
-
-    # filter edges that are too far (i.e., larger than the threshold)
-    if threshold is not None:
-        adj[adj > threshold] = 0
-
-    edge_list = nonzero(adj)
-    graph_instance.add_edges(list(edge_list[0]), list(edge_list[1]))
+    k = min(k_folds, num_nodes - 1)
+    if k > 0:
+        neighbors, keep = _k_nearest_neighbors(centroids, k, threshold)
+        src = repeat(arange(num_nodes), k)[keep.ravel()]
+        dst = neighbors.ravel()[keep.ravel()]
+    else:
+        src = dst = arange(0)
+
+    # create the graph with all of its nodes and edges at once
+    graph_instance = graph((as_tensor(src, dtype=int64), as_tensor(dst, dtype=int64)),
+                           num_nodes=num_nodes)
+    graph_instance.ndata[INDICES] = as_tensor(node_indices, dtype=int32)
+    graph_instance.ndata[CENTROIDS] = from_numpy(ascontiguousarray(centroids, dtype=float32))
+    graph_instance.ndata[FEATURES] = as_tensor(features)
+    graph_instance.ndata[PHENOTYPES] = as_tensor(phenotypes, dtype=torch_float32)
 
     return graph_instance
 
@@ -219,16 +328,19 @@ def _split_rois(graphs_by_label_and_specimen: Dict[int, Dict[str, List[DGLGraph]
 
             # Finish the allocation.
             # This method prioritizes bolstering the training and validation sets in that order.
-            n_used_of_remainder = 0
-            for specimen in specimens[i_specimen:]:
-                specimen_files = graphs_by_specimen[specimen]
-                if n_used_of_remainder < n_train:
-                    train_graphs[specimen] = specimen_files
-                elif n_used_of_remainder < n_train + n_validation:
-                    validation_graphs[specimen] = specimen_files
-                else:
-                    test_graphs[specimen] = specimen_files
-                n_used_of_remainder += len(specimen_files)
+            # Each remaining specimen goes to the first set whose quota isn't yet filled by the
+            # ROIs of the specimens before it, so the split points can be found all at once from
+            # the running ROI count.
+            remainder = specimens[i_specimen:]
+            n_used_before = cumsum([0] + [len(graphs_by_specimen[specimen])
+                                          for specimen in remainder])[:-1]
+            i_validation, i_test = searchsorted(n_used_before, [n_train, n_train + n_validation])
+            i_test = max(i_test, i_validation)  # n_validation can be negative
+            for set_graphs, set_specimens in ((train_graphs, remainder[:i_validation]),
+                                              (validation_graphs, remainder[i_validation:i_test]),
+                                              (test_graphs, remainder[i_test:])):
+                set_graphs.update((specimen, graphs_by_specimen[specimen])
+                                  for specimen in set_specimens)
 
     return train_graphs, validation_graphs, test_graphs
 
@@ -239,9 +351,14 @@ def generate_graphs(df_feat_all_specimens: DataFrame,
                     test_data_percent: int,
                     roi_side_length: int,
                     target_column: Optional[str] = None,
-                    save_path: Optional[str] = None
+                    save_path: Optional[str] = None,
+                    compact_features: bool = False
                     ) -> List[GraphData]:
-    "Generate cell graphs from SPT server files and save to disk if requested."
+    """Generate cell graphs from SPT server files and save to disk if requested.
+
+    If compact_features, node features are saved as int8 instead of float32, which shrinks each
+    graph file. load_cell_graphs casts them back to float32.
+    """
 
     # Handle inputs
     if not 0 <= validation_data_percent < 100:
@@ -281,20 +398,24 @@ def generate_graphs(df_feat_all_specimens: DataFrame,
 
     # Create the graphs
     graphs_by_label_and_specimen, graph_names = _create_graphs_from_spt_file(
-        df_feat_all_specimens, df_label_all_specimens, roi_size, target_column=target_column)
+        df_feat_all_specimens, df_label_all_specimens, roi_size, target_column=target_column,
+        compact_features=compact_features)
 
     # Split graphs into train/validation/test sets as requested
     sets_data = _split_rois(graphs_by_label_and_specimen, p_validation, p_test)
 
-    # Create dict of graph to label
+    # Create dict of graph to label, and the label tensors to save alongside each graph once
     graph_to_label: Dict[DGLGraph, int] = {}
+    label_tensors: Dict[int, Tensor] = {}
     for label, graphs_by_specimen in graphs_by_label_and_specimen.items():
+        label_tensors[label] = Tensor([label])
         for graph_list in graphs_by_specimen.values():
             for graph_instance in graph_list:
                 graph_to_label[graph_instance] = label
 
     # Write graphs to file in train/validation/test sets if requested
     graphs_data: List[GraphData] = []
+    graph_paths: List[str] = []
     for i, set_data in enumerate(sets_data):
         for specimen, graphs in set_data.items():
             if save_path is not None:
@@ -309,8 +430,14 @@ def generate_graphs(df_feat_all_specimens: DataFrame,
                 graphs_data.append(GraphData(graph_instance, label,
                                              name, specimen, TRAIN_VALIDATION_TEST[i]))
                 if save_path is not None:
-                    save_graphs(join(specimen_directory, name + '.bin'),
-                                [graph_instance],
-                                {'label': Tensor([label])})
+                    graph_paths.append(join(specimen_directory, name + '.bin'))
+
+    # Each ROI is its own small file, so write them concurrently rather than waiting on each
+    # file's I/O in turn
+    if save_path is not None:
+        with ThreadPoolExecutor(max_workers=min(32, (cpu_count() or 1) + 4)) as executor:
+            list(executor.map(lambda path, graph_data: save_graphs(
+                path, [graph_data.graph], {'label': label_tensors[graph_data.label]}),
+                graph_paths, graphs_data))
 
     return graphs_data
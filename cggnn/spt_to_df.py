@@ -1,23 +1,51 @@
 """
 Query SPT PSQL database for cell-level attributes and slide-level labels and return as DataFrames.
 """
+from os import cpu_count
 from os.path import exists
 from base64 import b64decode
-from mmap import mmap
+from struct import unpack_from
 from json import dump
-from typing import List, Union, Tuple, Optional, Dict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple, Optional, Dict, List, Any
 
 from psycopg2 import connect
-from numpy import sort
-from pandas import DataFrame, Series, read_sql, read_hdf
-from shapefile import Reader
+from numpy import sort, array, frombuffer, concatenate, ndarray, float32
+from pandas import DataFrame, read_sql, read_hdf
 
 from cggnn.util import load_label_to_result
 
+SHP_FILE_HEADER_LENGTH = 100
+SHP_RECORD_HEADER_LENGTH = 8
+
+
+def _read_sql_in_chunks(conn,
+                        query: str,
+                        column_dtypes: Dict[str, Any],
+                        chunk_size: int = 100_000
+                        ) -> DataFrame:
+    """Run a query through a server-side cursor and build the DataFrame from typed columns.
+
+    Rows are only fetched chunk_size at a time and converted to column arrays as they arrive, so
+    the full result set never exists as Python row tuples at once like it does with read_sql.
+    """
+    chunks: Dict[str, List[ndarray]] = {column: [] for column in column_dtypes}
+    with conn.cursor(name='cggnn_chunked_query') as cursor:
+        cursor.itersize = chunk_size
+        cursor.execute(query)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+            for (column, dtype), values in zip(column_dtypes.items(), zip(*rows)):
+                chunks[column].append(array(values, dtype=object).astype(dtype))
+    return DataFrame({column: concatenate(chunks[column]) if (len(chunks[column]) > 0)
+                      else array([], dtype=dtype) for column, dtype in column_dtypes.items()})
+
 
 def _get_targets(conn, measurement_study: str) -> DataFrame:
     "Get all target values for all cells."
-    df_targets = read_sql(f"""
+    return _read_sql_in_chunks(conn, f"""
         SELECT
             eq.histological_structure,
             eq.target,
@@ -38,11 +66,7 @@ def _get_targets(conn, measurement_study: str) -> DataFrame:
             sdmp.study='{measurement_study}' AND
             hs.anatomical_entity='cell'
         ORDER BY sdmp.specimen, eq.histological_structure, eq.target;
-    """, conn)
-    df_targets['histological_structure'] = df_targets['histological_structure'].astype(
-        int)
-    df_targets['target'] = df_targets['target'].astype(int)
-    return df_targets
+    """, {'histological_structure': int, 'target': int, 'coded_value': int, 'specimen': object})
 
 
 def _get_target_names(conn) -> Dict[int, str]:
@@ -77,7 +101,7 @@ def _get_phenotypes(conn, analysis_study: str) -> DataFrame:
 
 def _get_shape_strings(conn, measurement_study: str) -> DataFrame:
     "Get the shapefile strings for each histological structure."
-    df_shapes = read_sql(f"""
+    return _read_sql_in_chunks(conn, f"""
         SELECT  
             histological_structure,
             base64_contents AS shp_string
@@ -96,38 +120,42 @@ def _get_shape_strings(conn, measurement_study: str) -> DataFrame:
             sdmp.study='{measurement_study}' AND
             hs.anatomical_entity='cell'
         ORDER BY histological_structure;
-    """, conn)
-    df_shapes['histological_structure'] = df_shapes['histological_structure'].astype(
-        int)
-    return df_shapes
+    """, {'histological_structure': int, 'shp_string': object})
+
 
+def _extract_centroid(shapefile_base64_ascii: str) -> Tuple[float, float]:
+    """Convert shapefile string to center coordinate.
 
-def _extract_points(row: Series) -> Tuple[float, float]:
-    "Convert shapefile string to center coordinate."
-    shapefile_base64_ascii: str = row['shp_string']
+    Each string is a whole .shp file holding one polygon, so its fixed layout is read directly
+    (see pages 2-8 of the ESRI Shapefile Technical Description) instead of through a Reader.
+    """
     bytes_original = b64decode(shapefile_base64_ascii.encode('utf-8'))
-    mm = mmap(-1, len(bytes_original))
-    mm.write(bytes_original)
-    mm.seek(0)
-    sf = Reader(shp=mm)
-    shape_type = sf.shape(0).shapeType
-    shape_type_name = sf.shape(0).shapeTypeName
+    record_content = SHP_FILE_HEADER_LENGTH + SHP_RECORD_HEADER_LENGTH
+    (shape_type,) = unpack_from('<i', bytes_original, record_content)
     # 5 is "Polygon" according to page 4 of specification
     if shape_type != 5:
         raise ValueError(f'Expected shape type index is 5, not {shape_type}.')
-    if shape_type_name != 'POLYGON':
-        raise ValueError(
-            f'Expected shape type is "POLYGON", not {shape_type_name}.')
-    coords = sf.shape(0).points[:-1]
-    row['center_x'] = sum((coord[0] for coord in coords))/len(coords)
-    row['center_y'] = sum((coord[1] for coord in coords))/len(coords)
-    return row
+
+    # After the shape type and bounding box come the number of parts and points, the index of
+    # each part's first point, and then the points themselves as x, y doubles
+    n_parts, n_points = unpack_from('<2i', bytes_original, record_content + 36)
+    points = frombuffer(bytes_original, dtype='<f8', count=2*n_points,
+                        offset=record_content + 44 + 4*n_parts).reshape(-1, 2)
+
+    # The last point closes the polygon by repeating the first, so leave it out
+    center_x, center_y = points[:-1].mean(axis=0).tolist()
+    return center_x, center_y
 
 
 def _get_centroids(df: DataFrame) -> DataFrame:
     "Get the centroids from a dataframe with histological structure and shapefile strings."
     df = df.copy()
-    df = df.apply(_extract_points, axis=1)
+    # Every cell's shapefile is decoded independently, so spread them across processes
+    n_workers = cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        centroids = list(executor.map(_extract_centroid, df['shp_string'].to_numpy(),
+                                      chunksize=max(1, df.shape[0]//(4*n_workers))))
+    df[['center_x', 'center_y']] = array(centroids, dtype=float).reshape(-1, 2)
     df.drop('shp_string', axis=1, inplace=True)
     df.set_index('histological_structure', inplace=True)
     return df
@@ -141,24 +169,28 @@ def _create_cell_df(df_targets: DataFrame,
 
     # Reorganize targets data so that the indices is the histological structure
     # and the columns are the target values / chemical species
-    columns: List[Union[int, str]] = list(range(df_targets['target'].min(),
-                                                df_targets['target'].max()+1)) \
-        + ['specimen']
-    df = DataFrame(columns=columns,
-                   index=df_targets['histological_structure'].unique())
+    df = df_targets.pivot(index='histological_structure', columns='target',
+                          values='coded_value'
+                          ).reindex(index=df_targets['histological_structure'].unique(),
+                                    columns=range(df_targets['target'].min(),
+                                                  df_targets['target'].max()+1))
     df.index.name = 'histological_structure'
-    for hs, df_hs in df_targets.groupby('histological_structure'):
-        data = df_hs[['target', 'coded_value']].sort_values(
-            'target').set_index('target').T.iloc[0, ].to_dict()
-        data['specimen'] = df_hs['specimen'].iloc[0]
-        df.loc[hs, ] = Series(data)
-
-    # Check if each cell matches each phenotype signature and add
-    for phenotype, df_p in df_phenotypes.groupby('name'):
-        criteria = df_p[['marker', 'coded_value']
-                        ].set_index('marker').T.iloc[0]
-        df['PH_' + phenotype] = (df.loc[:, criteria.index]
-                                 == criteria).all(axis=1)
+    df.columns.name = None
+    df['specimen'] = df_targets.drop_duplicates('histological_structure').set_index(
+        'histological_structure')['specimen']
+
+    # Check if each cell matches each phenotype signature and add. A cell matches when every
+    # marker in the signature has the required value, i.e. when its count of positive markers the
+    # signature wants positive plus negative markers it wants negative is the signature's length.
+    # Those counts for every cell and phenotype are two matrix products. (Missing values count as
+    # neither positive nor negative, so they never match.)
+    criteria = df_phenotypes.pivot(index='name', columns='marker', values='coded_value')
+    cell_markers = df[criteria.columns].to_numpy(dtype=float32)
+    n_matching = (cell_markers == 1).astype(float32) @ \
+        (criteria == 1).to_numpy(dtype=float32).T + \
+        (cell_markers == 0).astype(float32) @ (criteria == 0).to_numpy(dtype=float32).T
+    phenotype_matches = n_matching == criteria.notna().sum(axis=1).to_numpy()
+    df[['PH_' + phenotype for phenotype in criteria.index]] = phenotype_matches
 
     # Rename columns from target int indices to their text names
     df.rename(target_names, axis=1, inplace=True)
@@ -188,6 +220,17 @@ def _create_label_df(conn, specimen_study: str) -> Tuple[DataFrame, Dict[int, st
     return df.replace({res: i for i, res in label_to_result.items()}), label_to_result
 
 
+def _output_filenames(output_name: str) -> Tuple[str, str, str]:
+    "Paths spt_to_dataframes saves the cell, label, and label-to-result data to."
+    return (output_name + '_cells.h5', output_name + '_labels.h5',
+            output_name + '_label_to_result.json')
+
+
+def outputs_saved(output_name: str) -> bool:
+    "Whether spt_to_dataframes has already saved its output under output_name."
+    return all(exists(filename) for filename in _output_filenames(output_name))
+
+
 def spt_to_dataframes(analysis_study: str,
                       measurement_study: str,
                       specimen_study: str,
@@ -199,10 +242,8 @@ def spt_to_dataframes(analysis_study: str,
                       ) -> Tuple[DataFrame, DataFrame, Dict[int, str]]:
     "Query SPT PSQL database for cell-level attributes and slide-level labels and return."
     if output_name is not None:
-        dict_filename = output_name + '_label_to_result.json'
-        label_filename = output_name + '_labels.h5'
-        cells_filename = output_name + '_cells.h5'
-        if exists(label_filename) and exists(cells_filename) and exists(dict_filename):
+        cells_filename, label_filename, dict_filename = _output_filenames(output_name)
+        if outputs_saved(output_name):
             return (read_hdf(cells_filename), read_hdf(label_filename),
                     load_label_to_result(dict_filename))
     conn = connect(host=host, dbname=dbname,
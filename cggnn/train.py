@@ -2,29 +2,112 @@
 """
 Train CG-GNN models
 """
-from os import makedirs, listdir
+from os import makedirs
 from os.path import exists, join
 from shutil import rmtree
-from typing import Callable, List, Tuple, Optional, Any, Sequence, Dict
+from functools import lru_cache
+from typing import Callable, List, Tuple, Optional, Any, Sequence, Dict, Union, Iterable, Iterator
 
 from numpy import ndarray, array
-from torch import save, load, no_grad, argmax, cat
-from torch.cuda import is_available
+from torch import (Tensor, save, no_grad, argmax, cat, empty, autocast, bfloat16, float16,
+                   device, dtype)
+from torch.cuda import is_available, is_bf16_supported, Stream, stream, current_stream
+from torch.cuda.amp import GradScaler
 from torch.optim import Adam, Optimizer
-from torch.nn import CrossEntropyLoss
+from torch.nn import CrossEntropyLoss, Module
 from torch.nn.functional import softmax
 from torch.utils.data import ConcatDataset, DataLoader, SubsetRandomSampler
 from sklearn.model_selection import KFold
-from sklearn.metrics import accuracy_score, f1_score, classification_report
+from sklearn.metrics import precision_recall_fscore_support, classification_report
 from dgl import DGLGraph
 from tqdm import tqdm
 
-from cggnn.util import CellGraphModel, CGDataset, collate, instantiate_model
+from cggnn.util import (CellGraphModel, CGDataset, instantiate_model, load_checkpoint,
+                        make_loader)
 from cggnn.util.constants import DEFAULT_GNN_PARAMETERS, DEFAULT_CLASSIFICATION_PARAMETERS
 
 # cuda support
 IS_CUDA = is_available()
-DEVICE = 'cuda:0' if IS_CUDA else 'cpu'
+DEVICE = device('cuda' if IS_CUDA else 'cpu')
+
+
+@lru_cache(maxsize=None)
+def _amp_dtype() -> dtype:
+    """Mixed precision type for GPU forward passes, preferring bf16 as it needs no loss scaling.
+
+    Checked on first use rather than at import, since querying bf16 support initializes CUDA.
+    """
+    return bfloat16 if (IS_CUDA and is_bf16_supported()) else float16
+
+
+def _autocast() -> autocast:
+    "Mixed precision context for training forward passes, a no-op when not using CUDA."
+    return autocast('cuda', dtype=_amp_dtype(), enabled=IS_CUDA)
+
+
+def _to_device(batch: Sequence[Any]) -> List[Any]:
+    "Move every element of a collated batch to the training device."
+    return [item.to(DEVICE, non_blocking=True) for item in batch]
+
+
+def _device_batches(batches: Iterable[Sequence[Any]]) -> Iterator[List[Any]]:
+    """Yield each batch on the training device.
+
+    Using CUDA, the next batch is copied over on a side stream while the caller computes on the
+    current one, so transfers overlap with the forward and backward passes.
+    """
+    if not IS_CUDA:
+        for batch in batches:
+            yield _to_device(batch)
+        return
+
+    copy_stream = Stream()
+
+    def copy(batch: Sequence[Any]) -> List[Any]:
+        with stream(copy_stream):
+            return _to_device(batch)
+
+    def ready(batch: List[Any]) -> List[Any]:
+        compute_stream = current_stream()
+        compute_stream.wait_stream(copy_stream)
+        for item in batch:
+            # the copies were allocated on copy_stream, so keep them alive until compute is done
+            item.record_stream(compute_stream)
+        return batch
+
+    upcoming: Optional[List[Any]] = None
+    for batch in batches:
+        if upcoming is not None:
+            current = ready(upcoming)
+            upcoming = copy(batch)
+            yield current
+        else:
+            upcoming = copy(batch)
+    if upcoming is not None:
+        yield ready(upcoming)
+
+
+def _evaluation_batches(dataset: CGDataset, batch_size: int
+                        ) -> Union[DataLoader, List[Tuple[Any, ...]]]:
+    "Batches for an unshuffled pass, collated once and reused if the dataset is held in RAM."
+    if dataset.load_in_ram:
+        return dataset.prebatched(batch_size)
+    return make_loader(dataset, batch_size)
+
+
+def _compile_model(model: CellGraphModel) -> Module:
+    """Compile a wrapper around the model's forward pass if this version of torch supports it.
+
+    The wrapper shares the model's parameters and is only used to run batches. Checkpoints and
+    the model returned to callers stay the uncompiled module, since hooks that explainers register
+    on its submodules don't fire inside a compiled forward pass.
+    """
+    try:
+        from torch import compile as compile_module  # added in torch 2.0
+    except ImportError:
+        return model
+    # Cell graphs vary in size, so compile for dynamic shapes
+    return compile_module(model, dynamic=True)
 
 
 def _set_save_path(model_path: str) -> str:
@@ -81,77 +164,91 @@ def _create_training_dataloaders(train_ids: Optional[Sequence[int]],
                                  train_dataset: CGDataset,
                                  validation_dataset: Optional[CGDataset],
                                  batch_size: int
-                                 ) -> Tuple[DataLoader, DataLoader]:
+                                 ) -> Tuple[DataLoader, Union[DataLoader, List[Tuple[Any, ...]]]]:
     "Determine whether to k-fold and then create dataloaders."
     if (train_ids is None) or (test_ids is None):
         if validation_dataset is None:
             raise ValueError("validation_dataset must exist.")
-        train_dataloader = DataLoader(
-            train_dataset,
-            batch_size=batch_size,
-            shuffle=True,
-            collate_fn=collate
-        )
-        validation_dataloader = DataLoader(
-            validation_dataset,
-            batch_size=batch_size,
-            shuffle=True,
-            collate_fn=collate
-        )
+        train_dataloader = make_loader(train_dataset, batch_size, shuffle=True)
+        validation_dataloader = _evaluation_batches(validation_dataset, batch_size)
     else:
         if validation_dataset is not None:
             raise ValueError(
                 "validation_dataset provided but k-folding of training dataset requested.")
         train_subsampler = SubsetRandomSampler(train_ids)
         test_subsampler = SubsetRandomSampler(test_ids)
-        train_dataloader = DataLoader(
-            train_dataset,
-            batch_size=batch_size,
-            sampler=train_subsampler,
-            collate_fn=collate
-        )
-        validation_dataloader = DataLoader(
-            train_dataset,
-            batch_size=batch_size,
-            sampler=test_subsampler,
-            collate_fn=collate
-        )
+        train_dataloader = make_loader(train_dataset, batch_size, sampler=train_subsampler)
+        validation_dataloader = make_loader(train_dataset, batch_size, sampler=test_subsampler)
 
     return train_dataloader, validation_dataloader
 
 
-def _train_step(model: CellGraphModel,
+def _train_step(model: Module,
                 train_dataloader: DataLoader,
                 loss_fn: Callable,
                 optimizer: Optimizer,
+                scaler: GradScaler,
                 epoch: int,
                 fold: int,
                 step: int
-                ) -> Tuple[CellGraphModel, int]:
-    "Train for 1 epoch/fold."
+                ) -> int:
+    "Train for 1 epoch/fold, returning the updated step count."
 
     model.train()
-    for batch in tqdm(train_dataloader, desc=f'Epoch training {epoch}, fold {fold}', unit='batch'):
+    for batch in _device_batches(tqdm(train_dataloader, desc=f'Epoch training {epoch}, fold {fold}',
+                                      unit='batch')):
 
         # 1. forward pass
         labels = batch[-1]
         data = batch[:-1]
-        logits = model(*data)
+        with _autocast():
+            logits = model(*data)
+            loss = loss_fn(logits, labels)
 
         # 2. backward pass
-        loss = loss_fn(logits, labels)
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         # 4. increment step
         step += 1
 
-    return model, step
+    return step
+
+
+def _collect_logits_and_labels(model: Module,
+                               num_classes: int,
+                               dataloader: Union[DataLoader, List[Tuple[Any, ...]]],
+                               desc: str
+                               ) -> Tuple[Tensor, Tensor]:
+    "Run the model over every batch, writing logits into a single preallocated on-device buffer."
+    n_examples = len(dataloader.sampler) if isinstance(dataloader, DataLoader) else \
+        sum(len(batch[-1]) for batch in dataloader)
+    all_logits = empty((n_examples, num_classes), device=DEVICE)
+    all_labels = []
+    offset = 0
+    for batch in _device_batches(tqdm(dataloader, desc=desc, unit='batch')):
+        labels = batch[-1]
+        data = batch[:-1]
+        with no_grad():
+            logits = model(*data)
+        all_logits[offset:offset + logits.shape[0]] = logits
+        offset += logits.shape[0]
+        all_labels.append(labels)
+    return all_logits, cat(all_labels)
+
+
+def _accuracy_and_weighted_f1_score(labels: ndarray, predictions: ndarray) -> Tuple[float, float]:
+    "Compute accuracy and weighted F1 score in as few passes over the labels as possible."
+    _, _, f1_scores, support = precision_recall_fscore_support(
+        labels, predictions, average=None, zero_division=0)
+    return (predictions == labels).mean(), (f1_scores*support).sum()/support.sum()
 
 
 def _validation_step(model: CellGraphModel,
-                     validation_dataloader: DataLoader,
+                     forward_model: Module,
+                     validation_dataloader: Union[DataLoader, List[Tuple[Any, ...]]],
                      loss_fn: Callable,
                      model_path: str,
                      epoch: int,
@@ -161,25 +258,14 @@ def _validation_step(model: CellGraphModel,
                      best_validation_accuracy: float,
                      best_validation_weighted_f1_score: float
                      ) -> CellGraphModel:
-    "Run validation step."
+    "Run validation step, using forward_model to run the model and saving model's weights."
 
     model.eval()
-    all_validation_logits = []
-    all_validation_labels = []
-    for batch in tqdm(validation_dataloader, desc=f'Epoch validation {epoch}, fold {fold}',
-                      unit='batch'):
-        labels = batch[-1]
-        data = batch[:-1]
-        with no_grad():
-            logits = model(*data)
-        all_validation_logits.append(logits)
-        all_validation_labels.append(labels)
+    all_validation_logits, all_validation_labels = _collect_logits_and_labels(
+        forward_model, model.num_classes, validation_dataloader,
+        f'Epoch validation {epoch}, fold {fold}')
 
-    all_validation_logits = cat(all_validation_logits).cpu()
-    all_validation_predictions = argmax(all_validation_logits, dim=1)
-    all_validation_labels = cat(all_validation_labels).cpu()
-
-    # compute & store loss + model
+    # compute & store loss + model, on device so only the scalar loss is copied back
     with no_grad():
         loss = loss_fn(all_validation_logits, all_validation_labels).item()
     if loss < best_validation_loss:
@@ -187,19 +273,18 @@ def _validation_step(model: CellGraphModel,
         save(model.state_dict(), join(
             model_path, 'model_best_validation_loss.pt'))
 
-    # compute & store accuracy + model
-    all_validation_predictions = all_validation_predictions.detach().numpy()
-    all_validation_labels = all_validation_labels.detach().numpy()
-    accuracy = accuracy_score(all_validation_labels,
-                              all_validation_predictions)
+    # compute & store accuracy and weighted f1-score + model
+    all_validation_predictions = argmax(
+        all_validation_logits, dim=1).detach().cpu().numpy()
+    all_validation_labels = all_validation_labels.detach().cpu().numpy()
+    accuracy, weighted_f1_score = _accuracy_and_weighted_f1_score(
+        all_validation_labels, all_validation_predictions)
     if accuracy > best_validation_accuracy:
         best_validation_accuracy = accuracy
         save(model.state_dict(), join(
             model_path, 'model_best_validation_accuracy.pt'))
 
-    # compute & store weighted f1-score + model
-    weighted_f1_score = f1_score(
-        all_validation_labels, all_validation_predictions, average='weighted')
+    # store weighted f1-score + model
     if weighted_f1_score > best_validation_weighted_f1_score:
         best_validation_weighted_f1_score = weighted_f1_score
         save(model.state_dict(), join(
@@ -213,6 +298,7 @@ def _validation_step(model: CellGraphModel,
 
 
 def _test_model(model: CellGraphModel,
+                forward_model: Module,
                 test_dataset: CGDataset,
                 batch_size: int,
                 loss_fn: Callable,
@@ -220,12 +306,7 @@ def _test_model(model: CellGraphModel,
                 step: int
                 ) -> CellGraphModel:
     model.eval()
-    test_dataloader = DataLoader(
-        test_dataset,
-        batch_size=batch_size,
-        shuffle=True,
-        collate_fn=collate
-    )
+    test_dataloader = _evaluation_batches(test_dataset, batch_size)
 
     max_acc = -1.
     max_acc_model_checkpoint = {}
@@ -235,41 +316,25 @@ def _test_model(model: CellGraphModel,
 
         print(f'\n*** Start testing w/ {metric} model ***')
 
-        model_name = [f for f in listdir(
-            model_path) if f.endswith(".pt") and metric in f][0]
-        checkpoint = load(join(model_path, model_name))
+        checkpoint = load_checkpoint(join(model_path, f'model_{metric}.pt'))
         model.load_state_dict(checkpoint)
 
-        all_test_logits = []
-        all_test_labels = []
-        for batch in tqdm(test_dataloader, desc=f'Testing: {metric}', unit='batch'):
-            labels = batch[-1]
-            data = batch[:-1]
-            with no_grad():
-                logits = model(*data)
-            all_test_logits.append(logits)
-            all_test_labels.append(labels)
-
-        all_test_logits = cat(all_test_logits).cpu()
-        all_test_preds = argmax(all_test_logits, dim=1)
-        all_test_labels = cat(all_test_labels).cpu()
-
-        # compute & store loss
+        all_test_logits, all_test_labels = _collect_logits_and_labels(
+            forward_model, model.num_classes, test_dataloader, f'Testing: {metric}')
+
+        # compute & store loss, on device so only the scalar loss is copied back
         with no_grad():
             loss = loss_fn(all_test_logits, all_test_labels).item()
 
-        # compute & store accuracy
-        all_test_preds = all_test_preds.detach().numpy()
-        all_test_labels = all_test_labels.detach().numpy()
-        accuracy = accuracy_score(all_test_labels, all_test_preds)
+        # compute & store accuracy and weighted f1-score
+        all_test_preds = argmax(all_test_logits, dim=1).detach().cpu().numpy()
+        all_test_labels = all_test_labels.detach().cpu().numpy()
+        accuracy, weighted_f1_score = _accuracy_and_weighted_f1_score(
+            all_test_labels, all_test_preds)
         if accuracy > max_acc:
             max_acc = accuracy
             max_acc_model_checkpoint = checkpoint
 
-        # compute & store weighted f1-score
-        weighted_f1_score = f1_score(
-            all_test_labels, all_test_preds, average='weighted')
-
         # compute and store classification report
         report = classification_report(
             all_test_labels, all_test_preds, digits=4)
@@ -296,9 +361,14 @@ def train(cell_graph_sets: Tuple[Tuple[List[DGLGraph], List[int]],
           k_folds: int = 0,
           gnn_parameters: Dict[str, Any] = DEFAULT_GNN_PARAMETERS,
           classification_parameters: Dict[str,
-                                          Any] = DEFAULT_CLASSIFICATION_PARAMETERS
+                                          Any] = DEFAULT_CLASSIFICATION_PARAMETERS,
+          compile_model: bool = False
           ) -> CellGraphModel:
-    "Train CG-GNN."
+    """Train CG-GNN.
+
+    If compile_model, batches are run through a torch.compile'd copy of the model's forward pass
+    (torch 2.0+). The model returned is always the uncompiled module.
+    """
 
     # set path to save checkpoints
     save_path = _set_save_path(save_path)
@@ -311,20 +381,26 @@ def train(cell_graph_sets: Tuple[Tuple[List[DGLGraph], List[int]],
     model = instantiate_model(cell_graph_sets[0],
                               gnn_parameters=gnn_parameters,
                               classification_parameters=classification_parameters)
+    forward_model = _compile_model(model) if compile_model else model
 
     # build optimizer
     optimizer = Adam(model.parameters(),
                      lr=learning_rate,
                      weight_decay=5e-4)
 
-    # define loss function
+    # define loss function, and loss scaling in case mixed precision is running in fp16
     loss_fn = CrossEntropyLoss()
+    scaler = GradScaler(enabled=IS_CUDA and (_amp_dtype() == float16))
 
     # training loop
     step: int = 0
     best_validation_loss: float = 10e5
     best_validation_accuracy: float = 0.
     best_validation_weighted_f1_score: float = 0.
+    # Without k-folding the split never changes, so build those loaders once. K-folds are
+    # re-split at random every epoch.
+    fixed_dataloaders = _create_training_dataloaders(
+        None, None, train_dataset, validation_dataset, batch_size) if (kfold is None) else None
     for epoch in range(epochs):
 
         folds: List[Tuple[Optional[Any], Optional[Any]]] = list(
@@ -333,28 +409,29 @@ def train(cell_graph_sets: Tuple[Tuple[List[DGLGraph], List[int]],
         for fold, (train_ids, test_ids) in enumerate(folds):
 
             # Determine whether to k-fold and if so how
-            train_dataloader, validation_dataloader = _create_training_dataloaders(
-                train_ids, test_ids, train_dataset, validation_dataset, batch_size)
+            train_dataloader, validation_dataloader = fixed_dataloaders if \
+                (fixed_dataloaders is not None) else _create_training_dataloaders(
+                    train_ids, test_ids, train_dataset, validation_dataset, batch_size)
 
             # A.) train for 1 epoch
             model = model.to(DEVICE)
-            model, step = _train_step(
-                model, train_dataloader, loss_fn, optimizer, epoch, fold, step)
+            step = _train_step(
+                forward_model, train_dataloader, loss_fn, optimizer, scaler, epoch, fold, step)
 
             # B.) validate
-            model = _validation_step(model, validation_dataloader, loss_fn, save_path, epoch, fold,
-                                     step, best_validation_loss, best_validation_accuracy,
-                                     best_validation_weighted_f1_score)
+            model = _validation_step(model, forward_model, validation_dataloader, loss_fn,
+                                     save_path, epoch, fold, step, best_validation_loss,
+                                     best_validation_accuracy, best_validation_weighted_f1_score)
 
     # testing loop
     if test_dataset is not None:
-        model = _test_model(model, test_dataset, batch_size,
+        model = _test_model(model, forward_model, test_dataset, batch_size,
                             loss_fn, save_path, step)
 
     return model
 
 
-def infer_with_model(model: CellGraphModel,
+def infer_with_model(model: Module,
                      cell_graphs: List[DGLGraph],
                      in_ram: bool = True,
                      batch_size: int = 1,
@@ -367,18 +444,19 @@ def infer_with_model(model: CellGraphModel,
     # make test data loader
     dataset = _create_dataset(cell_graphs, None, in_ram)
     assert dataset is not None
-    dataloader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate)
+    dataloader = make_loader(dataset, batch_size)
 
     # start testing
     all_test_logits = []
-    for data in tqdm(dataloader, desc='Testing', unit='batch'):
+    for data in _device_batches(tqdm(dataloader, desc='Testing', unit='batch')):
         with no_grad():
             logits = model(*data)
         all_test_logits.append(logits)
 
+    # Coalesce on device so only the final result is copied back
     coalesce_function = softmax if return_probability else argmax
-    return coalesce_function(cat(all_test_logits).cpu(),
-                             dim=1).detach().numpy()
+    return coalesce_function(cat(all_test_logits),
+                             dim=1).detach().cpu().numpy()
 
 
 def infer(cell_graphs: Tuple[List[DGLGraph], List[int]],
@@ -387,12 +465,14 @@ def infer(cell_graphs: Tuple[List[DGLGraph], List[int]],
           batch_size: int = 1,
           gnn_params: Dict[str, Any] = DEFAULT_GNN_PARAMETERS,
           classification_params: Dict[str,
-                                      Any] = DEFAULT_CLASSIFICATION_PARAMETERS
+                                      Any] = DEFAULT_CLASSIFICATION_PARAMETERS,
+          compile_model: bool = False
           ) -> None:
     """
     Test CG-GNN.
     Args:
         args (Namespace): parsed arguments.
+        compile_model (bool): run inference through a torch.compile'd forward pass (torch 2.0+).
     """
 
     # declare model and load weights
@@ -407,12 +487,11 @@ def infer(cell_graphs: Tuple[List[DGLGraph], List[int]],
     print(pytorch_total_params)
 
     all_test_preds = infer_with_model(
-        model, cell_graphs[0], in_ram, batch_size)
+        _compile_model(model) if compile_model else model, cell_graphs[0], in_ram, batch_size)
     all_test_labels = array(cell_graphs[1])
 
-    accuracy = accuracy_score(all_test_labels, all_test_preds)
-    weighted_f1_score = f1_score(
-        all_test_labels, all_test_preds, average='weighted')
+    accuracy, weighted_f1_score = _accuracy_and_weighted_f1_score(
+        all_test_labels, all_test_preds)
     report = classification_report(all_test_labels, all_test_preds)
 
     print(f'Test weighted F1 score {weighted_f1_score}')
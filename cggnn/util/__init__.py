@@ -1,3 +1,4 @@
 from cggnn.util.ml import CellGraphModel
-from cggnn.util.util import (GraphData, CGDataset, load_cell_graphs, collate, instantiate_model,
-                             load_label_to_result)
+from cggnn.util.util import (GraphData, CGDataset, load_cell_graphs, collate, make_loader,
+                             instantiate_model, load_checkpoint, load_label_to_result,
+                             load_column_names)
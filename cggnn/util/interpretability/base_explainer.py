@@ -29,7 +29,7 @@ class BaseExplainer(PipelineStep):
 
         # look for GPU
         self.cuda = torch.cuda.is_available()
-        self.device = torch.device("cuda:0" if self.cuda else "cpu")
+        self.device = torch.device("cuda" if self.cuda else "cpu")
 
         # set model
         self.model = model
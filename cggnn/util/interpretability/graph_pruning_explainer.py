@@ -15,7 +15,7 @@ from .base_explainer import BaseExplainer
 from ..util import torch_to_numpy
 
 
-DEVICE = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 MODEL_MODULE = 'cggnn.util.ml'
 
 
@@ -87,8 +87,12 @@ class CellGraphModel(BaseModel):
 
         # 1. GNN layers over the cell graph
         if isinstance(graph, DGLGraph):
-            feats = graph.ndata[GNN_NODE_FEAT_IN]
-            graph_embeddings = self.cell_graph_gnn(graph, feats)
+            # The GNN layers write their hidden states into ndata, so scope those writes to this
+            # pass. Otherwise they overwrite the input features of graphs that get reused, like
+            # CGDataset's prebatched graphs on CPU, where .to(DEVICE) returns the graph itself.
+            with graph.local_scope():
+                feats = graph.ndata[GNN_NODE_FEAT_IN]
+                graph_embeddings = self.cell_graph_gnn(graph, feats)
         else:
             adj, feats = graph[0], graph[1]
             graph_embeddings = self.cell_graph_gnn(adj, feats)
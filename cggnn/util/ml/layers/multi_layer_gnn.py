@@ -45,6 +45,7 @@ class MultiLayerGNN(nn.Module):
             module = importlib.import_module(
                 GNN_MODULE.format(layer_type)
             )
+            layer_class = getattr(module, AVAILABLE_LAYER_TYPES[layer_type])
         else:
             raise ValueError(
                 'GNN type: {} not recognized. Options are: {}'.format(
@@ -60,7 +61,7 @@ class MultiLayerGNN(nn.Module):
         self.readout_type = readout_type
 
         # input layer
-        self.layers.append(getattr(module, AVAILABLE_LAYER_TYPES[layer_type])(
+        self.layers.append(layer_class(
             node_dim=input_dim,
             out_dim=output_dim,
             **kwargs
@@ -68,17 +69,14 @@ class MultiLayerGNN(nn.Module):
         )
         # hidden layers
         for i in range(1, num_layers - 1):
-            self.layers.append(
-                getattr(
-                    module,
-                    AVAILABLE_LAYER_TYPES[layer_type])(
-                    node_dim=output_dim,
-                    out_dim=output_dim,
-                    **kwargs
-                )
+            self.layers.append(layer_class(
+                node_dim=output_dim,
+                out_dim=output_dim,
+                **kwargs
+            )
             )
         # output layer
-        self.layers.append(getattr(module, AVAILABLE_LAYER_TYPES[layer_type])(
+        self.layers.append(layer_class(
             node_dim=output_dim,
             out_dim=output_dim,
             **kwargs
@@ -105,10 +103,16 @@ class MultiLayerGNN(nn.Module):
         :param cat: (bool) if concat the features at each conv layer
         :return:
         """
-        h_concat = []
-        for layer in self.layers:
-            h = layer(g, h)
-            h_concat.append(h)
+        if self.readout_op == "none":
+            # only the last layer's output is needed, so let intermediate activations be freed
+            h_concat = None
+            for layer in self.layers:
+                h = layer(g, h)
+        else:
+            h_concat = []
+            for layer in self.layers:
+                h = layer(g, h)
+                h_concat.append(h)
 
         if isinstance(g, dgl.DGLGraph):
 
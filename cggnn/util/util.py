@@ -1,14 +1,17 @@
 """Cell/tissue graph dataset utility functions."""
-from os import walk
-from os.path import join
+from os import DirEntry, scandir, cpu_count
+from concurrent.futures import ThreadPoolExecutor
 from importlib import import_module
+from inspect import signature
 from copy import deepcopy
 from json import load as json_load
 from typing import Tuple, List, Dict, Any, Optional, Iterable, NamedTuple, Literal, Set
 
-from torch import LongTensor, IntTensor, load
+from numpy import asarray
+from pandas import read_hdf
+from torch import as_tensor, int32, int64, float32, load, device, cat
 from torch.cuda import is_available
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, DataLoader, Sampler
 from dgl import batch, DGLGraph
 from dgl.data.utils import load_graphs
 
@@ -18,14 +21,22 @@ from cggnn.util.constants import (FEATURES, DEFAULT_GNN_PARAMETERS,
 
 
 IS_CUDA = is_available()
-DEVICE = 'cuda:0' if IS_CUDA else 'cpu'
+# index-less, so CUDA tensors go to whichever device is current, not always GPU 0
+DEVICE = device('cuda' if IS_CUDA else 'cpu')
+# Load checkpoints as plain tensors (torch 1.13+), memory mapping the file instead of reading it
+# all in up front (torch 2.1+), when this version of torch supports it.
+LOAD_KWARGS = {option: True for option in ('weights_only', 'mmap')
+               if option in signature(load).parameters}
+# Batches are collated on the CPU so DataLoader workers never touch CUDA. The consumer moves
+# each collated batch to DEVICE.
 COLLATE_USING = {
     'DGLGraph': batch,
     'DGLHeteroGraph': batch,
     'Tensor': lambda x: x,
-    'int': lambda x: IntTensor(x).to(DEVICE),
-    'int64': lambda x: IntTensor(x).to(DEVICE),
-    'float': lambda x: LongTensor(x).to(DEVICE)
+    'int': lambda x: as_tensor(x, dtype=int32),
+    'int64': lambda x: as_tensor(x, dtype=int32),
+    # CGDataset yields labels as floats, but they're class indices for CrossEntropyLoss
+    'float': lambda x: as_tensor(x, dtype=int64)
 }
 
 
@@ -35,6 +46,11 @@ def load_label_to_result(path: str) -> Dict[int, str]:
         open(path, encoding='utf-8')).items()}
 
 
+def load_column_names(cell_data_hdf_path: str) -> List[str]:
+    "Read only the first row of the SPT cell data HDF to find its column names."
+    return read_hdf(cell_data_hdf_path, start=0, stop=1).columns.tolist()
+
+
 class GraphData(NamedTuple):
     "Holds all data relevant to a cell graph instance."
     graph: DGLGraph
@@ -58,22 +74,38 @@ def load_cell_graphs(graph_path: str,
     if test:
         which_sets.add('test')
 
-    graphs: List[GraphData] = []
-    for directory_path, set_names, _ in walk(graph_path):
-        for set_name in set_names:
-            if set_name in {'train', 'test', 'validation'}:
-                for set_path, specimens, _ in walk(join(directory_path, set_name)):
-                    for specimen in specimens:
-                        for specimen_path, _, graph_names in walk(join(set_path, specimen)):
-                            for graph_name in graph_names:
-                                assert isinstance(graph_name, str)
-                                if graph_name.endswith('.bin'):
-                                    graph, label = load_graph(
-                                        join(specimen_path, graph_name))
-                                    graphs.append(
-                                        GraphData(graph, label, graph_name[:-4], specimen,
-                                                  set_name))
-    return graphs
+    graph_files: List[Tuple[str, str, str, str]] = []
+    for set_entry in _sorted_entries(graph_path):
+        if set_entry.is_dir() and (set_entry.name in {'train', 'test', 'validation'}):
+            for specimen_entry in _sorted_entries(set_entry.path):
+                if specimen_entry.is_dir():
+                    for graph_entry in _sorted_entries(specimen_entry.path):
+                        if graph_entry.name.endswith('.bin') and graph_entry.is_file():
+                            graph_files.append((graph_entry.path, graph_entry.name[:-4],
+                                                specimen_entry.name, set_entry.name))
+
+    # Deserialization is I/O bound and mostly runs outside the GIL, so threads overlap the reads.
+    with ThreadPoolExecutor(max_workers=min(32, (cpu_count() or 1) + 4)) as executor:
+        graph_packets = list(executor.map(load_graphs, [path for path, _, _, _ in graph_files]))
+    if len(graph_packets) == 0:
+        return []
+    # convert every label to a Python int in one go rather than calling .item() per graph
+    labels: List[int] = cat([packet[1]['label'].reshape(-1) for packet in graph_packets]).tolist()
+    # graphs saved with compact_features hold int8 features, so give every graph float32 ones to
+    # keep graphs from different runs batchable together
+    for packet in graph_packets:
+        graph = packet[0][0]
+        if graph.ndata[FEATURES].dtype != float32:
+            graph.ndata[FEATURES] = graph.ndata[FEATURES].to(float32)
+    return [GraphData(packet[0][0], label, name, specimen, set_name)
+            for packet, label, (_, name, specimen, set_name)
+            in zip(graph_packets, labels, graph_files)]
+
+
+def _sorted_entries(path: str) -> List[DirEntry]:
+    "List a directory's entries by name, using the file types scandir already read."
+    with scandir(path) as entries:
+        return sorted(entries, key=lambda entry: entry.name)
 
 
 def load_graph(graph_path) -> Tuple[DGLGraph, int]:
@@ -97,7 +129,8 @@ class CGDataset(Dataset):
         Args:
             cell_graphs (Tuple[List[DGLGraph], List[int]]):
                 Cell graphs for a given split (e.g., test) and their labels.
-            load_in_ram (bool, optional): Loading data in RAM. Defaults to False.
+            load_in_ram (bool, optional): Loading data in RAM. Allows the dataset to be collated
+                into fixed batches once and reused, see prebatched. Defaults to False.
         """
         super(CGDataset, self).__init__()
 
@@ -105,6 +138,7 @@ class CGDataset(Dataset):
         self.cell_graph_labels = cell_graph_labels
         self.n_cell_graphs = len(self.cell_graphs)
         self.load_in_ram = load_in_ram
+        self._prebatched: Optional[Tuple[int, List[Tuple[Any, ...]]]] = None
 
     def __getitem__(self, index):
         """
@@ -113,8 +147,6 @@ class CGDataset(Dataset):
             index (int): index of the example.
         """
         cell_graph = self.cell_graphs[index]
-        if IS_CUDA:
-            cell_graph = cell_graph.to('cuda:0')
         return cell_graph if (self.cell_graph_labels is None) \
             else (cell_graph, float(self.cell_graph_labels[index]))
 
@@ -122,6 +154,27 @@ class CGDataset(Dataset):
         """Return the number of samples in the dataset."""
         return self.n_cell_graphs
 
+    def prebatched(self, batch_size: int) -> List[Tuple[Any, ...]]:
+        """
+        Collate the dataset, in order, into batches of batch_size, reusing them on later calls.
+
+        Meant for passes that don't need shuffling, like validation and testing. Only the batches
+        for the most recent batch_size are kept; see clear_prebatched to free them.
+        Args:
+            batch_size (int): number of examples per batch.
+        """
+        if not self.load_in_ram:
+            raise ValueError('Only datasets loaded in RAM can be prebatched.')
+        if (self._prebatched is None) or (self._prebatched[0] != batch_size):
+            self._prebatched = (batch_size, [
+                collate([self[i] for i in range(start, min(start + batch_size, len(self)))])
+                for start in range(0, len(self), batch_size)])
+        return self._prebatched[1]
+
+    def clear_prebatched(self) -> None:
+        """Release the batches cached by prebatched."""
+        self._prebatched = None
+
 
 def instantiate_model(cell_graphs: Tuple[List[DGLGraph], List[int]],
                       gnn_parameters: Dict[str, Any] = DEFAULT_GNN_PARAMETERS,
@@ -134,13 +187,21 @@ def instantiate_model(cell_graphs: Tuple[List[DGLGraph], List[int]],
         gnn_params=gnn_parameters,
         classification_params=classification_parameters,
         node_dim=cell_graphs[0][0].ndata[FEATURES].shape[1],
-        num_classes=int(max(cell_graphs[1]))+1
+        num_classes=int(asarray(cell_graphs[1]).max())+1
     ).to(DEVICE)
     if model_checkpoint_path is not None:
-        model.load_state_dict(load(model_checkpoint_path))
+        model.load_state_dict(load_checkpoint(model_checkpoint_path))
     return model
 
 
+def load_checkpoint(model_checkpoint_path: str) -> Dict[str, Any]:
+    """Deserialize a saved model state dict.
+
+    Tensors are deserialized straight onto DEVICE rather than staged in host memory first.
+    """
+    return load(model_checkpoint_path, map_location=DEVICE, **LOAD_KWARGS)
+
+
 def collate(example_batch):
     """
     Collate a batch.
@@ -153,15 +214,30 @@ def collate(example_batch):
 
     # collate the data
     if isinstance(example_batch[0], tuple):  # graph and label
-        def collate_fn(batch, id, type):
-            return COLLATE_USING[type]([example[id] for example in batch])
-        num_modalities = len(example_batch[0])
-        return tuple([collate_fn(example_batch, mod_id, type(example_batch[0][mod_id]).__name__)
-                      for mod_id in range(num_modalities)])
+        return tuple(COLLATE_USING[type(column[0]).__name__](list(column))
+                     for column in zip(*example_batch))
     else:  # graph only
         return tuple([COLLATE_USING[type(example_batch[0]).__name__](example_batch)])
 
 
+def make_loader(dataset: Dataset,
+                batch_size: int,
+                shuffle: bool = False,
+                sampler: Optional[Sampler] = None) -> DataLoader:
+    """Create a DataLoader of collated cell graph batches, pinned if using CUDA.
+
+    Use this wherever cell graphs are batched so training, validation, testing, and inference all
+    share one loader configuration. Graphs are already in memory by the time they're batched, so
+    collating them in the calling process is faster than shipping them to worker processes.
+    """
+    return DataLoader(dataset,
+                      batch_size=batch_size,
+                      shuffle=shuffle,
+                      sampler=sampler,
+                      collate_fn=collate,
+                      pin_memory=IS_CUDA)
+
+
 def dynamic_import_from(source_file: str, class_name: str) -> Any:
     """Do a from source_file import class_name dynamically
 
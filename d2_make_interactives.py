@@ -3,11 +3,10 @@
 from argparse import ArgumentParser
 from typing import Dict, List, DefaultDict
 
-from pandas import read_hdf
 from dgl import DGLGraph
 
 from cggnn.explain import generate_interactives
-from cggnn.util import load_cell_graphs
+from cggnn.util import load_cell_graphs, load_column_names
 
 
 def parse_arguments():
@@ -49,7 +48,7 @@ if __name__ == "__main__":
             graph_groups[g.specimen].append(g.graph)
         else:
             graph_groups[g.name].append(g.graph)
-    columns = read_hdf(args.cell_data_hdf_path).columns.values
+    columns = load_column_names(args.cell_data_hdf_path)
     generate_interactives(
         graph_groups,
         [col[3:] for col in columns if col.startswith('FT_')],
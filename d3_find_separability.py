@@ -1,10 +1,8 @@
 "Explain a cell graph (CG) prediction using a pretrained CG-GNN and a graph explainer."
 from argparse import ArgumentParser
 
-from pandas import read_hdf
-
 from cggnn.explain import calculate_separability
-from cggnn.util import load_cell_graphs, instantiate_model
+from cggnn.util import load_cell_graphs, instantiate_model, load_column_names
 
 
 def parse_arguments():
@@ -49,7 +47,7 @@ if __name__ == "__main__":
     cell_graphs = [d.graph for d in cell_graphs_data]
     cell_graph_labels = [d.label for d in cell_graphs_data]
     cell_graph_combo = (cell_graphs, cell_graph_labels)
-    columns = read_hdf(args.cell_data_hdf_path).columns.values
+    columns = load_column_names(args.cell_data_hdf_path)
     df_concept, df_aggregated, dfs_k_dist = calculate_separability(
         cell_graph_combo,
         instantiate_model(
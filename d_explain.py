@@ -1,10 +1,9 @@
 "Explain a cell graph (CG) prediction using a pretrained CG-GNN and a graph explainer."
 from argparse import ArgumentParser
 
-from pandas import read_hdf
-
 from cggnn.explain import explain_cell_graphs
-from cggnn.util import load_cell_graphs, instantiate_model, load_label_to_result
+from cggnn.util import (load_cell_graphs, instantiate_model, load_label_to_result,
+                        load_column_names)
 
 
 def parse_arguments():
@@ -66,7 +65,7 @@ if __name__ == "__main__":
     cell_graphs_data = load_cell_graphs(args.cg_path)
     cell_graphs = [d.graph for d in cell_graphs_data]
     cell_graph_combo = (cell_graphs, [d.label for d in cell_graphs_data])
-    columns = read_hdf(args.cell_data_hdf_path).columns.values
+    columns = load_column_names(args.cell_data_hdf_path)
     df_concept, df_aggregated, dfs_k_dist, importances = explain_cell_graphs(
         cell_graphs_data,
         instantiate_model(cell_graph_combo,
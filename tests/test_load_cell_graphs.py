@@ -0,0 +1,30 @@
+"Test loading cell graphs saved with float32 and compact int8 features together."
+from os import makedirs
+from os.path import join
+
+from torch import Tensor, float32, int8, ones
+from dgl import graph, batch
+from dgl.data.utils import save_graphs
+
+from cggnn.util import load_cell_graphs
+from cggnn.util.constants import FEATURES
+
+
+def _save_graph(directory: str, name: str, feature_dtype) -> None:
+    "Save a three-node graph with features of the given dtype, as generate_graphs would."
+    makedirs(directory, exist_ok=True)
+    cell_graph = graph(([0, 1], [1, 2]), num_nodes=3)
+    cell_graph.ndata[FEATURES] = ones((3, 4), dtype=feature_dtype)
+    save_graphs(join(directory, f'{name}.bin'), [cell_graph], {'label': Tensor([1])})
+
+
+def test_mixed_feature_dtypes_load_as_float32(tmp_path):
+    specimen_directory = join(str(tmp_path), 'train', 'specimen')
+    _save_graph(specimen_directory, 'old', float32)
+    _save_graph(specimen_directory, 'new', int8)
+
+    graphs = load_cell_graphs(str(tmp_path))
+
+    assert [graph_data.name for graph_data in graphs] == ['new', 'old']
+    assert all(graph_data.graph.ndata[FEATURES].dtype == float32 for graph_data in graphs)
+    assert batch([graph_data.graph for graph_data in graphs]).ndata[FEATURES].shape == (6, 4)